@@ -1,221 +1,2518 @@
-import numpy as np
+import _thread
+import contextvars
+import functools
+import importlib
+import itertools
+import math
+import numbers
+import operator
+import os
+import sys
+import time
+import warnings
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import struct
+
+class LazyModule():
+
+    # Stands in for a module global until an attribute is first read, then
+    # imports the module and rebinds the global to it. Keeps NumPy (and the
+    # heavier standard library modules) out of the import of the scalar core.
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+np = LazyModule('numpy', 'np')
+futures = LazyModule('concurrent.futures', 'futures')
+shared_memory = LazyModule('multiprocessing.shared_memory', 'shared_memory')
+tracemalloc = LazyModule('tracemalloc', 'tracemalloc')
 
 class Quaternion():
 
-    def __init__(self,a=0,b=0,c=0,d=0):
+    # Four float components and the cached string - no per-instance __dict__
+    __slots__ = ('_a', '_b', '_c', '_d', '_str')
+
+    # (a+bi+cj+dk), each part printed as str(float)
+    _format = '({}{:+}i{:+}j{:+}k)'
+
+    # Built in __new__ rather than __init__, so the value is fixed once the
+    # object exists - a later q.__init__(...) is object.__init__ and changes nothing
+    def __new__(cls,a=0.0,b=0.0,c=0.0,d=0.0):
+
+        # Four floats (what the operators pass) need no checks or conversion
+        if type(a) is not float or type(b) is not float or type(c) is not float or type(d) is not float:
+
+            if (type(a) == complex) or (type(b) == complex):
+                a,b,c,d = a.real, a.imag , b.real, b.imag
+
+            if type(a) == Quaternion:
+                a,b,c,d = a._a, a._b, a._c, a._d
+
+            # Validate once here so reads never need to re-check
+            for digit in (a,b,c,d):
+                if not isinstance(digit, (int, float)) or type(digit) == bool:
+                    raise TypeError('Element not a real number.')
+            a,b,c,d = float(a), float(b), float(c), float(d)
+
+        # Immutable value - slots are only written here (and by the str cache)
+        self = _new_object(cls)
+        _set_a(self, a)
+        _set_b(self, b)
+        _set_c(self, c)
+        _set_d(self, d)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Quaternion is immutable.')
 
-        if (type(a) == complex) or (type(b) == complex):
-            a,b,c,d = a.real, a.imag , b.real, b.imag
+    def __delattr__(self, name):
+        raise AttributeError('Quaternion is immutable.')
 
-        if type(a) == Quaternion:
-            a,b,c,d = a._q
+    def __reduce__(self):
+        return (Quaternion, self._q)
 
-        self._q = (a,b,c,d)
+    @property
+    def _q(self):
+        return (self._a, self._b, self._c, self._d)
 
     # self[item]
     def __getitem__(self,item):
         return self._q[(item)]
 
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(type(x) == np.ndarray and x.dtype == object for x in inputs):
+            # Object arrays of Quaternions keep working elementwise
+            inputs = [object_scalar(x) if type(x) == Quaternion else x for x in inputs]
+            return getattr(ufunc, method)(*inputs, **kwargs)
+        return quaternion_ufunc(ufunc, method, inputs, kwargs)
+
     def quaternion_test(self):
-        if type(self._q) != tuple:
-            raise TypeError('Input is not tuple.')
-        if len(self._q) != 4:
-            raise ValueError('Input is not length 4.')
-        for digit in self._q:
-            if type(digit) != int and type(digit) != float:
-                raise TypeError('Element not a real number.')
+        # Components are validated once in __init__
         return None
 
     @property
     def real(self):
-        self.quaternion_test()
-        return(self._q[0])
+        return self._a
 
     @property
     def imag(self):
-        self.quaternion_test()
-        return(self._q[1])
+        return self._b
 
     @property
     def jmag(self):
-        self.quaternion_test()
-        return(self._q[2])
+        return self._c
 
     @property
     def kmag(self):
-        self.quaternion_test()
-        return(self._q[3])
+        return self._d
 
     @property
     def scalar(self):
-        self.quaternion_test()
-        return(self._q[0])
+        return self._a
 
     @property
     def vector(self):
-        self.quaternion_test()
-        return (self._q[1], self._q[2], self._q[3])
+        return (self._b, self._c, self._d)
 
     @property
     def complex_pair(self):
-        self.quaternion_test()
-        return (self.real+self.imag*1j, self.jmag+self.kmag*1j)
+        return (self._a+self._b*1j, self._c+self._d*1j)
 
     @property
     def matrix(self):
-        self.quaternion_test()
-        return np.array([[self.real+self.imag*1j, self.jmag+self.kmag*1j],
-                        [-1*self.jmag+self.kmag*1j, self.real-self.imag*1j]])
+        if _cache is not None:
+            return cached(Quaternion._matrix, self).copy()
+        return self._matrix()
+
+    def _matrix(self):
+        return np.array([[self._a+self._b*1j, self._c+self._d*1j],
+                        [-1*self._c+self._d*1j, self._a-self._b*1j]])
 
     def __str__(self):
-        self.quaternion_test()
-        string = '('
-        if self.real > 0:
-            string += str(self.real)
-        elif self.real < 0:
-            string += str(self.real)
-        else: # if element == 0
-            string += str(self.real)
-        if self.imag > 0:
-            string += '+' + str(self.imag) + 'i'
-        elif self.imag < 0:
-            string += str(self.imag) + 'i'
-        else: # if element == 0
-            string += '+' + str(self.imag) + 'i'
-        if self.jmag > 0:
-            string += '+' + str(self.jmag) + 'j'
-        elif self.jmag < 0:
-            string += str(self.jmag) + 'j'
-        else: # if element == 0
-            string += '+' + str(self.jmag) + 'j'
-        if self.kmag > 0:
-            string += '+' + str(self.kmag) + 'k'
-        elif self.kmag < 0:
-            string += str(self.kmag) + 'k'
-        else: # if element == 0
-            string += '+' + str(self.kmag) + 'k'
-        string += ')'
-        return string
+        # Formatted once - components never change after __init__
+        try:
+            return self._str
+        except AttributeError:
+            _set_str(self, self._format.format(self._a, self._b, self._c, self._d))
+            return self._str
 
     def __repr__(self):
         return str(self)
 
     def __pos__(self):
-        self.quaternion_test()
         return self
 
     def __neg__(self):
-        self.quaternion_test()
-        return Quaternion(-1*self.real, -1*self.imag, -1*self.jmag, -1*self.kmag)
+        return Quaternion(-self._a, -self._b, -self._c, -self._d)
+
+    # Binary operators read (trimmed) components with operands() and build
+    # exactly one result Quaternion - no converted copies or intermediates
 
     def __add__(self, other):
-        self, other = test(self, other)
-        #if type(other) == np.ndarray:
-        #    return NotImplemented
-        #else:
-        return Quaternion(self.real + other.real, self.imag + other.imag, self.jmag + other.jmag, self.kmag + other.kmag)
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(self, other)
+        return Quaternion(a1 + a2, b1 + b2, c1 + c2, d1 + d2)
 
     def __radd__(self, other):
-        self, other = test(self, other)
-        return other + self
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(other, self)
+        return Quaternion(a1 + a2, b1 + b2, c1 + c2, d1 + d2)
 
     def __sub__(self, other):
-        self, other = test(self, other)
-        return self + -other
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(self, other)
+        return Quaternion(a1 - a2, b1 - b2, c1 - c2, d1 - d2)
 
     def __rsub__(self, other):
-        self, other = test(self, other)
-        return -self + other
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(other, self)
+        return Quaternion(a1 - a2, b1 - b2, c1 - c2, d1 - d2)
 
     def __mul__(self, other):
-        self, other = test(self, other)
-
-        a = self.real*other.real - self.imag*other.imag - self.jmag*other.jmag - self.kmag*other.kmag
-        b = self.real*other.imag + self.imag*other.real + self.jmag*other.kmag - self.kmag*other.jmag
-        c = self.real*other.jmag - self.imag*other.kmag + self.jmag*other.real + self.kmag*other.imag
-        d = self.real*other.kmag + self.imag*other.jmag - self.jmag*other.imag + self.kmag*other.real
-
-        # Trim floats to 14dp - handles big numbers in scientific notation
-        return Quaternion(float('{:0.14e}'.format(a)), float('{:0.14e}'.format(b)), float('{:0.14e}'.format(c)), float('{:0.14e}'.format(d)))
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        return Quaternion(*product(*operands(self, other)))
 
     def __rmul__(self, other):
-        self, other = test(self, other)
-        return other * self
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        return Quaternion(*product(*operands(other, self)))
 
     def conjugate(self):
-        self.quaternion_test()
-        return Quaternion(self.real, -1*self.imag, -1*self.jmag, -1*self.kmag)
+        return Quaternion(self._a, -self._b, -self._c, -self._d)
 
     def inverse(self):
-        self.quaternion_test()
+        if _cache is not None:
+            return cached(Quaternion._inverse, self)
+        return self._inverse()
+
+    def _inverse(self):
+        if _numeric_mode.get(_default_mode).digits is None:
+            return Quaternion(*exact_inverse(self._a, self._b, self._c, self._d))
         # q_inv = q_conjugate / (q_norm)^2
         # Norm square inverse
-        conj = self.conjugate()
-        nsi = 1/(conj * self)[0]
-        return Quaternion(nsi*conj.real, nsi*conj.imag, nsi*conj.jmag, nsi*conj.kmag)
+        nsi = 1/norm_squared(self._a, self._b, self._c, self._d)
+        return Quaternion(nsi*self._a, -nsi*self._b, -nsi*self._c, -nsi*self._d)
 
     def __truediv__(self, other):
-        self, other = test(self, other)
-        return self * other.inverse()
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(self, other)
+        return Quaternion(*product(a1, b1, c1, d1, *inverse_of(a2, b2, c2, d2)))
 
     def __rtruediv__(self, other):
-        self, other = test(self, other)
-        return self.inverse() * other
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        a1, b1, c1, d1, a2, b2, c2, d2 = operands(self, other)
+        return Quaternion(*product(*inverse_of(a1, b1, c1, d1), a2, b2, c2, d2))
 
     def __eq__(self, other):
-        self, other = test(self, other)
+        if type(other) not in _scalar_operands and defers(other):
+            return NotImplemented
+        try:
+            a1, b1, c1, d1, a2, b2, c2, d2 = operands(self, other)
+        except TypeError:
+            # Not a number - Python then falls back to identity, so q == None is False
+            return NotImplemented
+        tolerance = _numeric_mode.get(_default_mode).tolerance
+        if tolerance == 0:
+            return a1 == a2 and b1 == b2 and c1 == c2 and d1 == d2
+        return (abs(a1 - a2) <= tolerance and abs(b1 - b2) <= tolerance
+                and abs(c1 - c2) <= tolerance and abs(d1 - d2) <= tolerance)
 
-        diff = self - other
-        result = True
-        for i in range(4):
-            if diff[i] != 0:
-                result = False
-        return result
+    def __hash__(self):
+        # Hashes the components __eq__ compares (trimmed to the current digits),
+        # so equal Quaternions hash the same. A number x hashes like an equal
+        # Quaternion only if trimming leaves x unchanged (3 or 1+2j, not 0.1+0.2).
+        # A tolerance makes == intransitive, so use rotation_key() for near matches.
+        a, b, c, d = components(self)
+        if c == 0 and d == 0:
+            return hash(complex(a, b))
+        return hash((a, b, c, d))
+
+    def rotation_key(self, resolution=1e-9):
+        # Hashable key for the rotation of q - the unit quaternion quantised to
+        # steps of resolution, with q and -q (the same rotation) sharing a key
+        nsq = self._a*self._a + self._b*self._b + self._c*self._c + self._d*self._d
+        if nsq == 0:
+            raise ZeroDivisionError('Quaternion has zero norm.')
+        norm = math.sqrt(nsq) * resolution
+        key = (round(self._a / norm), round(self._b / norm), round(self._c / norm), round(self._d / norm))
+        for x in key:
+            if x:
+                return key if x > 0 else (-key[0], -key[1], -key[2], -key[3])
+        return key
 
     def __pow__(self, n):
-        self.quaternion_test()
+        if _cache is not None:
+            return cached(Quaternion._pow, self, n)
+        return self._pow(n)
+
+    def _pow(self, n):
+        if type(n) == float:
+            # Polar form q**n = exp(n*log(q)), for fractional powers
+            if n == 0:
+                return Quaternion(1,0,0,0)
+            if self._a == self._b == self._c == self._d == 0:
+                if n < 0:
+                    raise ZeroDivisionError('Quaternion has zero norm.')
+                return Quaternion(0,0,0,0)
+            a, b, c, d = self.log()._q
+            return Quaternion(n*a, n*b, n*c, n*d).exp()
         if type(n) != int:
-            raise TypeError('Input n is not an int.')
+            raise TypeError('Input n is not an int or float.')
 
         if n == 0:
             return Quaternion(1,0,0,0)
-        elif n == 1:
-            return self
-        elif n == -1:
-            return self.inverse()
-        elif n > 1:
-            qi = self
-            for i in range(n-1):
-                qi *= self
-            return qi
-        elif n < -1:
-            qi = self.inverse()
-            for i in range(-n-1):
-                qi *= self.inverse()
-            return qi
+        # Square and multiply, with the inverse taken once for negative n
+        base = self if n > 0 else self.inverse()
+        n = abs(n)
+        qi = None
+        while True:
+            if n & 1:
+                qi = base if qi is None else qi * base
+            n >>= 1
+            if n == 0:
+                return qi
+            base = base * base
+
+    def exp(self):
+        # exp(a + v) = e^a (cos|v| + v/|v| sin|v|)
+        a, b, c, d = self._a, self._b, self._c, self._d
+        vnorm = math.sqrt(b*b + c*c + d*d)
+        ea = math.exp(a)
+        if vnorm == 0:
+            return Quaternion(ea, 0, 0, 0)
+        s = ea * math.sin(vnorm) / vnorm
+        return Quaternion(ea * math.cos(vnorm), s*b, s*c, s*d)
+
+    def log(self):
+        # log(q) = ln|q| + v/|v| acos(a/|q|)
+        # Negative reals take the axis i, as any unit vector would do
+        a, b, c, d = self._a, self._b, self._c, self._d
+        vnorm = math.sqrt(b*b + c*c + d*d)
+        norm = math.sqrt(a*a + vnorm*vnorm)
+        if norm == 0:
+            raise ZeroDivisionError('Quaternion has zero norm.')
+        theta = math.atan2(vnorm, a)
+        if vnorm == 0:
+            return Quaternion(math.log(norm), theta, 0, 0)
+        s = theta / vnorm
+        return Quaternion(math.log(norm), s*b, s*c, s*d)
 
     def __abs__(self):
-        self.quaternion_test()
-        return np.sqrt((self.conjugate() * self)[0])
+        return math.sqrt(norm_squared(self._a, self._b, self._c, self._d))
+
+    def norm(self):
+        return abs(self)
+
+    def norm_squared(self):
+        return norm_squared(self._a, self._b, self._c, self._d)
+
+    def normalize(self):
+        # Unit quaternion in the same direction (a new Quaternion, as they are immutable)
+        n = abs(self)
+        if n == 0:
+            raise ZeroDivisionError('Quaternion has zero norm.')
+        return Quaternion(self._a/n, self._b/n, self._c/n, self._d/n)
+
+    def rotate(self, v):
+        # Rotate a single 3-vector, returned as a tuple, without NumPy
+        return exact_rotate(self._a, self._b, self._c, self._d, float(v[0]), float(v[1]), float(v[2]))
+
+    def rotate_points(self, points):
+        # Rotate (N, 3) points by this quaternion's rotation (normalised first)
+        # One 3x3 matrix built directly from q, then a single matmul over all points
+        points = np.asarray(points, dtype=np.float64)
+        return (rotation_matrix_components(as_components(self)) @ points.T).T
+
+    # Rotation Conversions
+
+    def to_rotation_matrix(self):
+        if _cache is not None:
+            return cached(Quaternion._rotation_matrix, self).copy()
+        return self._rotation_matrix()
+
+    def _rotation_matrix(self):
+        return rotation_matrix_components(as_components(self))
+
+    @classmethod
+    def from_rotation_matrix(cls, m):
+        return cls(*from_rotation_matrix_components(m).tolist())
+
+    def to_axis_angle(self):
+        axis, angle = axis_angle_components(as_components(self))
+        return axis, float(angle)
+
+    @classmethod
+    def from_axis_angle(cls, axis, angle):
+        return cls(*from_axis_angle_components(axis, angle).tolist())
+
+    def to_euler(self, sequence='xyz'):
+        return euler_components(as_components(self), sequence)
+
+    @classmethod
+    def from_euler(cls, angles, sequence='xyz'):
+        return cls(*from_euler_components(angles, sequence).tolist())
+
+# Operand types the scalar operators always handle themselves
+_scalar_operands = frozenset((Quaternion, float, int, complex))
+
+# Allocation and slot setters that bypass Quaternion.__setattr__
+_new_object = object.__new__
+_set_a = Quaternion._a.__set__
+_set_b = Quaternion._b.__set__
+_set_c = Quaternion._c.__set__
+_set_d = Quaternion._d.__set__
+_set_str = Quaternion._str.__set__
+
+# Numeric Mode
+
+# digits - decimal places kept (in scientific notation) by convert() and the
+#          Hamilton product. None skips the rounding for pure float arithmetic.
+# tolerance - largest componentwise difference __eq__ treats as equal.
+# trim_format - format spec trim() uses for digits
+_NumericMode = namedtuple('_NumericMode', ('digits', 'tolerance', 'trim_format'))
+
+# set_numeric_mode() sets the default every thread starts from. numeric_mode()
+# overrides it through a context variable, so a block only changes the mode of
+# its own thread (or asyncio task) and never the results or hashes of another.
+_default_mode = _NumericMode(14, 0.0, '0.14e')
+_numeric_mode = contextvars.ContextVar('numeric_mode')
+# Default arguments of numeric_mode() that keep the current value
+_current = object()
+
+def make_mode(digits, tolerance):
+    if digits is not None and (type(digits) != int or digits < 0):
+        raise ValueError('Input digits is not a non-negative int or None.')
+    if tolerance < 0:
+        raise ValueError('Input tolerance is negative.')
+    return _NumericMode(digits, tolerance, None if digits is None else '0.{}e'.format(digits))
+
+def set_numeric_mode(digits=14, tolerance=0.0):
+    # Inside a numeric_mode() block this changes the mode of that block only
+    mode = make_mode(digits, tolerance)
+    if _numeric_mode.get(None) is None:
+        global _default_mode
+        _default_mode = mode
+    else:
+        _numeric_mode.set(mode)
+
+def get_numeric_mode():
+    mode = _numeric_mode.get(_default_mode)
+    return {'digits': mode.digits, 'tolerance': mode.tolerance}
+
+@contextmanager
+def numeric_mode(digits=_current, tolerance=_current):
+    # with numeric_mode(None): ... runs the block with exact float arithmetic.
+    # Arguments left out keep their current value.
+    mode = _numeric_mode.get(_default_mode)
+    token = _numeric_mode.set(make_mode(mode.digits if digits is _current else digits,
+                                        mode.tolerance if tolerance is _current else tolerance))
+    try:
+        yield
+    finally:
+        _numeric_mode.reset(token)
+
+# Derived Value Cache
+
+# Opt-in LRU cache of inverse(), ** and the matrix forms of Quaternions, keyed
+# on the bit exact components (so 0.0 and -0.0 differ), the arguments (with their types, as 2 and 2.0 take
+# different paths) and the digits of the numeric mode. Quaternions are
+# immutable so entries never go stale. None while the cache is disabled.
+_cache = None
+_cache_info = {'hits': 0, 'misses': 0, 'maxsize': 0}
+_cache_components = struct.Struct('<4d')
+# _thread.allocate_lock is threading.Lock, without importing threading
+_cache_lock = _thread.allocate_lock()
+
+def set_cache(maxsize=128):
+    # maxsize entries (least recently used dropped first), 0 or None disables
+    if maxsize is not None and (type(maxsize) != int or maxsize < 0):
+        raise ValueError('Input maxsize is not a non-negative int or None.')
+    global _cache
+    with _cache_lock:
+        if not maxsize:
+            _cache = None
+            _cache_info['maxsize'] = 0
+            return
+        if _cache is None:
+            _cache = OrderedDict()
+        while len(_cache) > maxsize:
+            _cache.popitem(last=False)
+        _cache_info['maxsize'] = maxsize
+
+def cache_info():
+    with _cache_lock:
+        info = dict(_cache_info)
+        info['size'] = 0 if _cache is None else len(_cache)
+    return info
+
+def clear_cache():
+    # Drops every entry and zeroes the hit and miss counts
+    with _cache_lock:
+        if _cache is not None:
+            _cache.clear()
+        _cache_info['hits'] = 0
+        _cache_info['misses'] = 0
+
+def cached(method, q, *args):
+    # method(q, *args) through the cache. The lock is not held while computing,
+    # so two threads may both miss on a key - the result is the same either way.
+    key = (method, _cache_components.pack(*q._q), args, tuple(map(type, args)), _numeric_mode.get(_default_mode).digits)
+    with _cache_lock:
+        if _cache is not None and key in _cache:
+            _cache.move_to_end(key)
+            _cache_info['hits'] += 1
+            return _cache[key]
+        _cache_info['misses'] += 1
+    value = method(q, *args)
+    with _cache_lock:
+        if _cache is not None:
+            _cache[key] = value
+            if len(_cache) > _cache_info['maxsize']:
+                _cache.popitem(last=False)
+    return value
 
 # Helper Functions
 
 def convert(elem):
+    if _numeric_mode.get(_default_mode).digits is None:
+        # Exact mode - plain floats, no rounding
+        if type(elem) == float or type(elem) == int:
+            return Quaternion(float(elem), 0, 0, 0)
+        elif type(elem) == complex:
+            return Quaternion(elem.real, elem.imag, 0, 0)
+        elif type(elem) == Quaternion:
+            return elem
+        return convert(as_number(elem))
     if type(elem) == float or type(elem) == int:
     # Trim floats to 14dp - big numbers in handles scientific notation
-        return Quaternion(float('{:0.14e}'.format(elem)), 0, 0, 0)
+        return Quaternion(trim(elem), 0, 0, 0)
+    elif type(elem) == complex:
+        return Quaternion(trim(elem.real), trim(elem.imag), 0, 0)
+    elif type(elem) == Quaternion:
+        return Quaternion(trim(elem.real), trim(elem.imag), trim(elem.jmag), trim(elem.kmag))
+    # NumPy and other numeric scalars
+    return convert(as_number(elem))
+
+def as_number(elem):
+    if isinstance(elem, numbers.Real):
+        return float(elem)
+    elif isinstance(elem, numbers.Complex):
+        return complex(elem)
+    raise TypeError('Element not a number or Quaternion.')
+
+def trim(x):
+    trim_format = _numeric_mode.get(_default_mode).trim_format
+    if trim_format is None:
+        return x
+    return float(format(x, trim_format))
+
+def trimmed(q):
+    # trim() of four components, reading the mode once
+    trim_format = _numeric_mode.get(_default_mode).trim_format
+    if trim_format is None:
+        return q
+    return (float(format(q[0], trim_format)), float(format(q[1], trim_format)),
+            float(format(q[2], trim_format)), float(format(q[3], trim_format)))
+
+def components(elem):
+    # Components of a number or Quaternion as a tuple, trimmed like convert()
+    # but without building a Quaternion
+    if type(elem) == Quaternion:
+        q = (elem._a, elem._b, elem._c, elem._d)
+    elif type(elem) == float or type(elem) == int:
+        q = (float(elem), 0.0, 0.0, 0.0)
     elif type(elem) == complex:
-        return Quaternion(float('{:0.14e}'.format(elem.real)), float('{:0.14e}'.format(elem.imag)), 0, 0)
-    #elif type(elem) == np.ndarray:
-    #    return elem
-    else: # type(elem) == Quaternion:
-        return Quaternion(float('{:0.14e}'.format(elem.real)), float('{:0.14e}'.format(elem.imag)), float('{:0.14e}'.format(elem.jmag)), float('{:0.14e}'.format(elem.kmag)))
+        q = (elem.real, elem.imag, 0.0, 0.0)
+    else:
+        return components(as_number(elem))
+    return trimmed(q)
+
+def operands(q, r):
+    # Eight components of two operands, in order
+    return components(q) + components(r)
+
+def product(a1, b1, c1, d1, a2, b2, c2, d2):
+    if _numeric_mode.get(_default_mode).digits is None:
+        return exact_product(a1, b1, c1, d1, a2, b2, c2, d2)
+    # Trim floats to 14dp - handles big numbers in scientific notation
+    return trimmed(exact_product(a1, b1, c1, d1, a2, b2, c2, d2))
+
+def norm_squared(a, b, c, d):
+    # Scalar part of q_conjugate * q, with operands and result trimmed like the product
+    if _numeric_mode.get(_default_mode).digits is None:
+        return exact_norm_squared(a, b, c, d)
+    return trim(exact_norm_squared(*trimmed((a, b, c, d))))
+
+def inverse_of(a, b, c, d):
+    # Inverse components, trimmed as an operand of a further product would be
+    if _numeric_mode.get(_default_mode).digits is None:
+        return exact_inverse(a, b, c, d)
+    nsi = 1/norm_squared(a, b, c, d)
+    return trimmed((nsi*a, -nsi*b, -nsi*c, -nsi*d))
+
+def defers(other):
+    # Whether the scalar operators leave other to its own (reflected) operator -
+    # QuaternionArrays, lazy Expressions and NumPy arrays. An ndarray needs
+    # NumPy to have been imported already, so this never imports it.
+    if isinstance(other, (QuaternionArray, Expression)):
+        return True
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(other, numpy.ndarray)
 
 def test(q, r):
+    # Quaternions are validated on construction, so converting is enough
     q = convert(q)
     r = convert(r)
-    #if type(q) != np.ndarray:
-    q.quaternion_test()
-    #if type(r) != np.ndarray:
-    r.quaternion_test()
     return q, r
+
+# Scalar Kernels
+
+# Plain float maths with no rounding, used in exact mode (and by rotate()).
+# They take and return only floats so they can be compiled.
+
+def exact_product(a1, b1, c1, d1, a2, b2, c2, d2):
+    return (a1*a2 - b1*b2 - c1*c2 - d1*d2,
+            a1*b2 + b1*a2 + c1*d2 - d1*c2,
+            a1*c2 - b1*d2 + c1*a2 + d1*b2,
+            a1*d2 + b1*c2 - c1*b2 + d1*a2)
+
+def exact_norm_squared(a, b, c, d):
+    return a*a + b*b + c*c + d*d
+
+def exact_inverse(a, b, c, d):
+    nsi = 1/(a*a + b*b + c*c + d*d)
+    return nsi*a, -nsi*b, -nsi*c, -nsi*d
+
+def exact_rotate(a, b, c, d, x, y, z):
+    # v + w*t + u x t with t = 2(u x v), for the unit form (w, u) of q
+    n = math.sqrt(a*a + b*b + c*c + d*d)
+    if n == 0:
+        raise ZeroDivisionError('Quaternion has zero norm.')
+    w, u1, u2, u3 = a/n, b/n, c/n, d/n
+    tx = 2*(u2*z - u3*y)
+    ty = 2*(u3*x - u1*z)
+    tz = 2*(u1*y - u2*x)
+    return (x + w*tx + u2*tz - u3*ty,
+            y + w*ty + u3*tx - u1*tz,
+            z + w*tz + u1*ty - u2*tx)
+
+# Backend - chosen once at import by the QUATERNION_BACKEND environment variable:
+#   python (default) - the kernels above as they are
+#   numba - the kernels compiled with numba.njit, falling back to python (with
+#           a warning) when Numba is not installed
+_backend = os.environ.get('QUATERNION_BACKEND', 'python')
+if _backend not in ('python', 'numba'):
+    raise ValueError("QUATERNION_BACKEND is not 'python' or 'numba'.")
+if _backend == 'numba':
+    try:
+        import numba
+    except ImportError:
+        warnings.warn('Numba is not installed, using the python backend.')
+        _backend = 'python'
+    else:
+        exact_product = numba.njit(cache=True)(exact_product)
+        exact_norm_squared = numba.njit(cache=True)(exact_norm_squared)
+        exact_inverse = numba.njit(cache=True)(exact_inverse)
+        exact_rotate = numba.njit(cache=True)(exact_rotate)
+
+def get_backend():
+    return _backend
+
+
+# Quaternion Arrays
+
+# Storage dtype -> dtype the kernels compute in. float16 halves the memory of
+# float32 again but is storage only, every operation runs in float32.
+_compute_dtypes = {
+    'float64': 'float64',
+    'float32': 'float32',
+    'float16': 'float32',
+}
+
+class QuaternionArray():
+
+    def __init__(self, data=(), dtype=None):
+
+        # Copies another QuaternionArray, but wraps a float ndarray without
+        # copying so views and memory maps stay shared. Without a dtype the
+        # storage dtype of the input is kept (float64 for anything else).
+        if type(data) == QuaternionArray:
+            if dtype is None:
+                dtype = data.dtype
+            data = data._q.astype(dtype)
+        elif type(data) == Quaternion:
+            data = [data._q]
+        elif isinstance(data, np.ndarray) and data.dtype != object:
+            if dtype is None and data.dtype.name in _compute_dtypes:
+                dtype = data.dtype
+        else:
+            data = [elem._q if type(elem) == Quaternion else elem for elem in data]
+
+        dtype = np.dtype(np.float64 if dtype is None else dtype)
+        if dtype.name not in _compute_dtypes:
+            raise ValueError('Input dtype is not float16, float32 or float64.')
+
+        # Contiguous (N, 4) buffer, one row per quaternion
+        q = np.ascontiguousarray(data, dtype=dtype)
+        if q.size == 0:
+            q = q.reshape(0, 4)
+        if q.ndim != 2 or q.shape[1] != 4:
+            raise ValueError('Input is not shape (N, 4).')
+        self._q = q
+
+    # NumPy ufuncs and functions (np.multiply, np.conjugate, np.abs, reductions,
+    # np.concatenate, ...) dispatch to the vectorised kernels below
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        return quaternion_ufunc(ufunc, method, inputs, kwargs)
+
+    def __array_function__(self, func, types, args, kwargs):
+        name = numpy_name(func)
+        if name not in _array_functions:
+            return NotImplemented
+        return _array_functions[name](*args, **kwargs)
+
+    def __len__(self):
+        return self._q.shape[0]
+
+    # self[item]
+    def __getitem__(self, item):
+        if type(item) == int or isinstance(item, np.integer):
+            return Quaternion(*[float(x) for x in self._q[item]])
+        return QuaternionArray(self._q[item])
+
+    def __setitem__(self, item, value):
+        array_dtype((self, value))
+        self._q[item] = as_components(value)
+
+    def __iter__(self):
+        for row in self._q.tolist():
+            yield Quaternion(*row)
+
+    @property
+    def real(self):
+        return self._q[:, 0]
+
+    @property
+    def imag(self):
+        return self._q[:, 1]
+
+    @property
+    def jmag(self):
+        return self._q[:, 2]
+
+    @property
+    def kmag(self):
+        return self._q[:, 3]
+
+    @property
+    def scalar(self):
+        return self._q[:, 0]
+
+    @property
+    def vector(self):
+        return self._q[:, 1:]
+
+    def tolist(self):
+        return list(self)
+
+    def __str__(self):
+        return '[' + ', '.join(Quaternion._format.format(*row) for row in self._q.tolist()) + ']'
+
+    def __repr__(self):
+        return 'QuaternionArray(' + str(self) + ')'
+
+    @property
+    def dtype(self):
+        return self._q.dtype
+
+    def astype(self, dtype):
+        # Explicit cast to another storage dtype, always a copy
+        return QuaternionArray(self, dtype)
+
+    # Kernels run on _components() and operands converted by _operand(), then
+    # _wrap() stores the result back in this array's dtype
+    def _components(self):
+        return self._q.astype(_compute_dtypes[self.dtype.name], copy=False)
+
+    def _operand(self, other):
+        array_dtype((self, other))
+        return operand_components(other).astype(_compute_dtypes[self.dtype.name], copy=False)
+
+    def _wrap(self, q):
+        return QuaternionArray(q.astype(self.dtype, copy=False))
+
+    def __pos__(self):
+        return self
+
+    def __neg__(self):
+        return QuaternionArray(-self._q)
+
+    def __add__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(self._components() + other)
+
+    def __radd__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(other + self._components())
+
+    def __sub__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(self._components() - other)
+
+    def __rsub__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(other - self._components())
+
+    def __mul__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(hamilton(self._components(), other))
+
+    def __rmul__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(hamilton(other, self._components()))
+
+    def conjugate(self):
+        return QuaternionArray(conjugate_components(self._q))
+
+    def inverse(self):
+        return self._wrap(inverse_components(self._components()))
+
+    def __truediv__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return self._wrap(hamilton(self._components(), inverse_components(other)))
+
+    def __rtruediv__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        if type(other) == Quaternion:
+            other = self._operand(other)
+            return self._wrap(hamilton(other, inverse_components(self._components())))
+        # Numbers mirror Quaternion.__rtruediv__
+        other = self._operand(other)
+        return self._wrap(hamilton(inverse_components(self._components()), other))
+
+    def __eq__(self, other):
+        if type(other) == Expression:
+            return NotImplemented
+        other = self._operand(other)
+        return np.all(np.abs(self._components() - other) <= _numeric_mode.get(_default_mode).tolerance, axis=1)
+
+    def __ne__(self, other):
+        return ~(self == other)
+
+    def __pow__(self, n):
+        # NumPy scalars count as well, np.int64(2) like 2
+        if isinstance(n, numbers.Integral):
+            n = int(n)
+        elif isinstance(n, numbers.Real):
+            n = float(n)
+        else:
+            raise TypeError('Input n is not an int or float.')
+        if type(n) == float:
+            return self._wrap(pow_components(self._components(), n))
+
+        if n == 0:
+            return self._wrap(np.tile(np.array([1, 0, 0, 0], dtype=self.dtype), (len(self), 1)))
+        # Square and multiply, with the inverse taken once for negative n
+        q = self._components()
+        base = q if n > 0 else inverse_components(q)
+        n = abs(n)
+        qi = None
+        while True:
+            if n & 1:
+                qi = base if qi is None else hamilton(qi, base)
+            n >>= 1
+            if n == 0:
+                return self._wrap(qi)
+            base = hamilton(base, base)
+
+    def exp(self):
+        return self._wrap(exp_components(self._components()))
+
+    def log(self):
+        return self._wrap(log_components(self._components()))
+
+    def __abs__(self):
+        return np.sqrt(self.norm_squared())
+
+    def norm(self):
+        return np.sqrt(self.norm_squared())
+
+    def norm_squared(self):
+        # Row dot products without an (N, 4) temporary
+        q = self._components()
+        return np.einsum('ij,ij->i', q, q)
+
+    def normalize(self):
+        # Scale every row to unit norm in place, and return self
+        nsq = self.norm_squared()
+        if np.any(nsq == 0):
+            raise ZeroDivisionError('Quaternion has zero norm.')
+        if self._q.dtype == _compute_dtypes[self.dtype.name]:
+            self._q /= np.sqrt(nsq)[:, None]
+        else:
+            self._q[...] = self._components() / np.sqrt(nsq)[:, None]
+        return self
+
+    def cumprod(self, **kwargs):
+        return cumprod(self, **kwargs)
+
+    def prod(self, **kwargs):
+        return prod(self, **kwargs)
+
+    def to_csv(self, file, **kwargs):
+        return to_csv(file, self, **kwargs)
+
+    def rotate_points(self, points):
+        # Rotate (N, 3) points, each by the matching quaternion (or broadcast)
+        q = self._components()
+        return rotate_components(q, np.asarray(points, dtype=q.dtype))
+
+    # Rotation Conversions
+
+    def to_rotation_matrix(self):
+        return rotation_matrix_components(self._components())
+
+    @classmethod
+    def from_rotation_matrix(cls, m):
+        return cls(from_rotation_matrix_components(m).reshape(-1, 4))
+
+    def to_axis_angle(self):
+        return axis_angle_components(self._components())
+
+    @classmethod
+    def from_axis_angle(cls, axis, angle):
+        return cls(from_axis_angle_components(axis, angle).reshape(-1, 4))
+
+    def to_euler(self, sequence='xyz'):
+        return euler_components(self._components(), sequence)
+
+    @classmethod
+    def from_euler(cls, angles, sequence='xyz'):
+        return cls(from_euler_components(angles, sequence).reshape(-1, 4))
+
+    def rotation_keys(self, resolution=1e-9):
+        # (N, 4) int64 rows of Quaternion.rotation_key, e.g. for np.unique(axis=0)
+        return rotation_key_components(self._components(), resolution)
+
+# Array Helper Functions
+
+def as_components(elem):
+    # Broadcastable float64 components of a number, Quaternion or QuaternionArray
+    if type(elem) == QuaternionArray:
+        return elem._q
+    elif type(elem) == Quaternion:
+        return np.array(elem._q, dtype=np.float64)
+    elif type(elem) == float or type(elem) == int:
+        return np.array([elem, 0, 0, 0], dtype=np.float64)
+    elif type(elem) == complex:
+        return np.array([elem.real, elem.imag, 0, 0], dtype=np.float64)
+    elif isinstance(elem, numbers.Number):
+        return as_components(as_number(elem))
+    elif isinstance(elem, (list, tuple)):
+        elem = [as_components(x) if type(x) == Quaternion else x for x in elem]
+    q = np.asarray(elem, dtype=np.float64)
+    if q.shape[-1:] != (4,):
+        raise ValueError('Input is not shape (..., 4).')
+    return q
+
+def hamilton(p, q):
+    # Elementwise Hamilton product of (..., 4) component arrays
+    a1, b1, c1, d1 = p[..., 0], p[..., 1], p[..., 2], p[..., 3]
+    a2, b2, c2, d2 = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    a = a1*a2 - b1*b2 - c1*c2 - d1*d2
+    b = a1*b2 + b1*a2 + c1*d2 - d1*c2
+    c = a1*c2 - b1*d2 + c1*a2 + d1*b2
+    d = a1*d2 + b1*c2 - c1*b2 + d1*a2
+
+    return np.stack((a, b, c, d), axis=-1)
+
+def conjugate_components(q):
+    out = np.negative(q)
+    out[..., 0] = q[..., 0]
+    return out
+
+def inverse_components(q):
+    # q_inv = q_conjugate / (q_norm)^2
+    nsq = np.sum(q * q, axis=-1, keepdims=True)
+    if np.any(nsq == 0):
+        raise ZeroDivisionError('Quaternion has zero norm.')
+    return conjugate_components(q) / nsq
+
+def unit_components(q):
+    nsq = np.sum(q * q, axis=-1, keepdims=True)
+    if np.any(nsq == 0):
+        raise ZeroDivisionError('Quaternion has zero norm.')
+    return q / np.sqrt(nsq)
+
+def geodesic_distance(p, q):
+    # Angle in [0, pi] of the rotation taking p to q (q and -q are the same
+    # rotation). 4 atan2(|p - q|, |p + q|) of the unit forms, with q flipped
+    # onto p's hemisphere, stays accurate for small angles where 2 acos|p.q|
+    # does not.
+    p, q = distance_operands(p, q)
+    angle = 4*np.arctan2(np.linalg.norm(p - q, axis=-1), np.linalg.norm(p + q, axis=-1))
+    return angle if angle.ndim else float(angle)
+
+def chordal_distance(p, q):
+    # Euclidean distance in [0, sqrt(2)] between the unit forms of p and q,
+    # the nearer of q and -q (2 sin(angle / 4), the cheaper metric)
+    p, q = distance_operands(p, q)
+    distance = np.linalg.norm(p - q, axis=-1)
+    return distance if distance.ndim else float(distance)
+
+def distance_operands(p, q):
+    # Unit components of p and q in their compute dtype, with q flipped to have
+    # a non-negative dot with p
+    compute = _compute_dtypes[array_dtype((p, q)).name]
+    p = unit_components(as_components(p).astype(compute, copy=False))
+    q = unit_components(as_components(q).astype(compute, copy=False))
+    return p, np.where(np.sum(p * q, axis=-1, keepdims=True) < 0, -q, q)
+
+def rotation_key_components(q, resolution):
+    # Unit quaternions quantised to steps of resolution, each row's first
+    # non-zero entry made positive so q and -q give the same key
+    key = np.round(unit_components(q) / resolution).astype(np.int64)
+    first = np.take_along_axis(key, np.argmax(key != 0, axis=-1)[..., None], axis=-1)
+    return np.where(first < 0, -key, key)
+
+def rotate_components(q, v):
+    # Direct rotation of (..., 3) vectors by the unit form of q, no sandwich product:
+    # t = 2(u x v), v' = v + w*t + u x t
+    q = unit_components(q)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    vx, vy, vz = v[..., 0], v[..., 1], v[..., 2]
+
+    tx = 2*(y*vz - z*vy)
+    ty = 2*(z*vx - x*vz)
+    tz = 2*(x*vy - y*vx)
+
+    return np.stack((vx + w*tx + y*tz - z*ty,
+                     vy + w*ty + z*tx - x*tz,
+                     vz + w*tz + x*ty - y*tx), axis=-1)
+
+def rotation_matrix_components(q):
+    # (..., 3, 3) rotation matrices of the unit form of q
+    q = unit_components(q)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    m = np.empty(q.shape[:-1] + (3, 3), dtype=q.dtype)
+    m[..., 0, 0] = 1 - 2*(y*y + z*z)
+    m[..., 0, 1] = 2*(x*y - w*z)
+    m[..., 0, 2] = 2*(x*z + w*y)
+    m[..., 1, 0] = 2*(x*y + w*z)
+    m[..., 1, 1] = 1 - 2*(x*x + z*z)
+    m[..., 1, 2] = 2*(y*z - w*x)
+    m[..., 2, 0] = 2*(x*z - w*y)
+    m[..., 2, 1] = 2*(y*z + w*x)
+    m[..., 2, 2] = 1 - 2*(x*x + y*y)
+    return m
+
+def from_rotation_matrix_components(m):
+    # Unit quaternions (w >= 0) of (..., 3, 3) rotation matrices.
+    # Shepperd's method - builds each quaternion from its largest component
+    # (the trace or a diagonal entry) to avoid dividing by a small number.
+    m = np.asarray(m, dtype=np.float64)
+    if m.shape[-2:] != (3, 3):
+        raise ValueError('Input is not shape (..., 3, 3).')
+    shape = m.shape[:-2]
+    m = m.reshape(-1, 3, 3)
+    rows = np.arange(len(m))
+
+    decision = np.empty((len(m), 4))
+    decision[:, :3] = np.diagonal(m, axis1=1, axis2=2)
+    decision[:, 3] = decision[:, :3].sum(axis=1)
+    choice = np.argmax(decision, axis=1)
+
+    q = np.empty((len(m), 4))
+
+    # Largest is a diagonal entry i - solve for that vector component first
+    ind = rows[choice != 3]
+    i = choice[ind]
+    j = (i + 1) % 3
+    k = (j + 1) % 3
+    q[ind, i+1] = 1 - decision[ind, 3] + 2*m[ind, i, i]
+    q[ind, j+1] = m[ind, j, i] + m[ind, i, j]
+    q[ind, k+1] = m[ind, k, i] + m[ind, i, k]
+    q[ind, 0] = m[ind, k, j] - m[ind, j, k]
+
+    # Largest is the trace - solve for the scalar part first
+    ind = rows[choice == 3]
+    q[ind, 0] = 1 + decision[ind, 3]
+    q[ind, 1] = m[ind, 2, 1] - m[ind, 1, 2]
+    q[ind, 2] = m[ind, 0, 2] - m[ind, 2, 0]
+    q[ind, 3] = m[ind, 1, 0] - m[ind, 0, 1]
+
+    q /= np.sqrt(np.sum(q * q, axis=1, keepdims=True))
+    q[q[:, 0] < 0] *= -1
+    return q.reshape(shape + (4,))
+
+def axis_angle_components(q):
+    # Unit axes (..., 3) and angles (...) in [0, 2pi] of the rotations of q.
+    # The zero rotation gets the axis (1, 0, 0).
+    q = unit_components(q)
+    sin_half = np.sqrt(np.sum(q[..., 1:] * q[..., 1:], axis=-1))
+    angle = 2*np.arctan2(sin_half, q[..., 0])
+
+    axis = np.zeros(q.shape[:-1] + (3,), dtype=q.dtype)
+    axis[..., 0] = 1
+    nonzero = sin_half > 0
+    axis[nonzero] = q[..., 1:][nonzero] / sin_half[nonzero][..., None]
+    return axis, angle
+
+def from_axis_angle_components(axis, angle):
+    axis = np.asarray(axis, dtype=np.float64)
+    angle = np.asarray(angle, dtype=np.float64)
+    if axis.shape[-1:] != (3,):
+        raise ValueError('Input axis is not shape (..., 3).')
+    norm = np.sqrt(np.sum(axis * axis, axis=-1, keepdims=True))
+    if np.any(norm == 0):
+        raise ValueError('Input axis has zero length.')
+    shape = np.broadcast_shapes(axis.shape[:-1], angle.shape)
+    half = np.broadcast_to(angle, shape)[..., None] / 2
+    q = np.empty(shape + (4,))
+    q[..., :1] = np.cos(half)
+    q[..., 1:] = np.sin(half) * axis / norm
+    return q
+
+def euler_axes(sequence):
+    # Axis indices and extrinsic flag of an Euler sequence. Lower case 'xyz' is
+    # extrinsic (fixed axes), upper case 'XYZ' is intrinsic (rotating axes).
+    if type(sequence) != str or len(sequence) != 3:
+        raise ValueError('Input sequence is not three axes.')
+    if sequence.islower():
+        extrinsic = True
+    elif sequence.isupper():
+        extrinsic = False
+    else:
+        raise ValueError('Input sequence mixes intrinsic and extrinsic axes.')
+    axes = ['xyz'.find(axis) for axis in sequence.lower()]
+    if -1 in axes:
+        raise ValueError('Input sequence axes must be x, y or z.')
+    if axes[0] == axes[1] or axes[1] == axes[2]:
+        raise ValueError('Input sequence repeats an axis consecutively.')
+    return axes, extrinsic
+
+def from_euler_components(angles, sequence='xyz'):
+    # Unit quaternions of (..., 3) Euler angles in radians
+    axes, extrinsic = euler_axes(sequence)
+    angles = np.asarray(angles, dtype=np.float64)
+    if angles.shape[-1:] != (3,):
+        raise ValueError('Input angles is not shape (..., 3).')
+
+    elementary = []
+    for n, axis in enumerate(axes):
+        half = angles[..., n] / 2
+        e = np.zeros(angles.shape[:-1] + (4,))
+        e[..., 0] = np.cos(half)
+        e[..., axis+1] = np.sin(half)
+        elementary.append(e)
+
+    # Fixed axes compose right to left, rotating axes left to right
+    if extrinsic:
+        elementary.reverse()
+    return hamilton(hamilton(elementary[0], elementary[1]), elementary[2])
+
+def euler_components(q, sequence='xyz'):
+    # (..., 3) Euler angles in [-pi, pi] of the rotations of q.
+    # Bernardes & Viollet's direct method; in gimbal lock the third angle is
+    # set to zero.
+    axes, extrinsic = euler_axes(sequence)
+    q = unit_components(q)
+    i, j, k = axes
+    if not extrinsic:
+        i, k = k, i
+
+    proper = i == k
+    if proper:
+        k = 3 - i - j
+    sign = (i - j) * (j - k) * (k - i) // 2
+
+    w, qi, qj, qk = q[..., 0], q[..., i+1], q[..., j+1], q[..., k+1]
+    if proper:
+        a, b, c, d = w, qi, qj, qk*sign
+    else:
+        a, b, c, d = w - qj, qi + qk*sign, qj + w, qk*sign - qi
+
+    angles = np.empty(q.shape[:-1] + (3,), dtype=q.dtype)
+    angles[..., 1] = 2*np.arctan2(np.hypot(c, d), np.hypot(a, b))
+
+    eps = 1e-7
+    lock_zero = np.abs(angles[..., 1]) <= eps
+    lock_pi = np.abs(angles[..., 1] - np.pi) <= eps
+    half_sum = np.arctan2(b, a)
+    half_diff = np.arctan2(d, c)
+
+    locked = np.where(lock_zero, 2*half_sum, 2*half_diff*(-1 if extrinsic else 1))
+    lock = lock_zero | lock_pi
+    # In gimbal lock all of the rotation goes on the first angle of the sequence
+    # (index 2 here for intrinsic sequences, which are reversed at the end)
+    angles[..., 0] = half_sum - half_diff
+    angles[..., 2] = half_sum + half_diff
+    first, last = (0, 2) if extrinsic else (2, 0)
+    angles[..., first] = np.where(lock, locked, angles[..., first])
+    angles[..., last] = np.where(lock, 0, angles[..., last])
+
+    # Tait-Bryan sequences
+    if not proper:
+        angles[..., 2] *= sign
+        angles[..., 1] -= np.pi/2
+    if not extrinsic:
+        angles = angles[..., ::-1].copy()
+
+    angles[angles < -np.pi] += 2*np.pi
+    angles[angles > np.pi] -= 2*np.pi
+    return angles
+
+def exp_components(q):
+    # exp(a + v) = e^a (cos|v| + v/|v| sin|v|)
+    vnorm = np.sqrt(np.sum(q[..., 1:] * q[..., 1:], axis=-1, keepdims=True))
+    ea = np.exp(q[..., :1])
+    # sin|v|/|v| -> 1 as |v| -> 0, np.sinc avoids the division
+    out = np.empty(q.shape, dtype=q.dtype)
+    out[..., :1] = ea * np.cos(vnorm)
+    out[..., 1:] = ea * np.sinc(vnorm / np.pi) * q[..., 1:]
+    return out
+
+def log_components(q):
+    # log(q) = ln|q| + v/|v| acos(a/|q|), negative reals take the axis i
+    vnorm = np.sqrt(np.sum(q[..., 1:] * q[..., 1:], axis=-1, keepdims=True))
+    norm = np.sqrt(q[..., :1] * q[..., :1] + vnorm * vnorm)
+    if np.any(norm == 0):
+        raise ZeroDivisionError('Quaternion has zero norm.')
+    theta = np.arctan2(vnorm, q[..., :1])
+    scale = np.divide(theta, vnorm, out=np.zeros(theta.shape, dtype=q.dtype), where=vnorm > 0)
+    out = np.empty(q.shape, dtype=q.dtype)
+    out[..., :1] = np.log(norm)
+    out[..., 1:] = scale * q[..., 1:]
+    out[..., 1:2] += np.where(vnorm == 0, theta, 0)
+    return out
+
+def pow_components(q, n):
+    # Polar form q**n = exp(n*log(q)); zero quaternions stay zero for n > 0
+    if n == 0:
+        return np.tile(np.array([1, 0, 0, 0], dtype=q.dtype), q.shape[:-1] + (1,))
+    zero = np.all(q == 0, axis=-1)
+    if np.any(zero):
+        if n < 0:
+            raise ZeroDivisionError('Quaternion has zero norm.')
+        out = np.zeros(q.shape, dtype=q.dtype)
+        out[~zero] = exp_components(n * log_components(q[~zero]))
+        return out
+    return exp_components(n * log_components(q))
+
+# Interpolation
+
+def slerp(q0, q1, t):
+    # Spherical linear interpolation from q0 (t = 0) to q1 (t = 1) along the
+    # shorter arc. Quaternions, QuaternionArrays and arrays of t broadcast.
+    # Like the operators, it runs in the compute dtype of the arrays' storage
+    # dtype and returns that storage dtype.
+    dtype = array_dtype((q0, q1))
+    compute = _compute_dtypes[dtype.name]
+    p = as_components(q0).astype(compute, copy=False)
+    q = as_components(q1).astype(compute, copy=False)
+    scalar = type(q0) != QuaternionArray and type(q1) != QuaternionArray and np.ndim(t) == 0
+    r = slerp_components(unit_components(p), unit_components(q), np.asarray(t, dtype=compute))
+    if scalar:
+        return Quaternion(*r.tolist())
+    return QuaternionArray(r.reshape(-1, 4).astype(dtype, copy=False))
+
+def squad(q0, a, b, q1, t):
+    # Spherical quadrangle interpolation from q0 to q1 with control points a and b
+    dtype = array_dtype((q0, a, b, q1))
+    compute = _compute_dtypes[dtype.name]
+    p, a, b, q = [unit_components(as_components(x).astype(compute, copy=False)) for x in (q0, a, b, q1)]
+    t = np.asarray(t, dtype=compute)
+    r = squad_components(p, a, b, q, t)
+    if np.ndim(t) == 0 and r.ndim == 1:
+        return Quaternion(*r.tolist())
+    return QuaternionArray(r.reshape(-1, 4).astype(dtype, copy=False))
+
+def squad_controls(keys):
+    # Squad control points a_i of a keyframe QuaternionArray, for C1 continuity:
+    # a_i = q_i exp(-(log(q_i^-1 q_i+1) + log(q_i^-1 q_i-1)) / 4)
+    dtype = array_dtype((keys,))
+    q = as_components(keys).astype(_compute_dtypes[dtype.name], copy=False)
+    q = continuous_components(unit_components(q))
+    return QuaternionArray(squad_control_components(q).astype(dtype, copy=False))
+
+def interpolate(times, keys, new_times, method='slerp'):
+    # Resample keyframes at times onto new_times in one vectorised pass.
+    # times must be increasing; new_times outside the range clamp to the ends.
+    times = np.asarray(times, dtype=np.float64)
+    new_times = np.asarray(new_times, dtype=np.float64)
+    dtype = array_dtype((keys,))
+    compute = _compute_dtypes[dtype.name]
+    q = continuous_components(unit_components(as_components(keys).astype(compute, copy=False)))
+    if q.ndim != 2 or len(q) != len(times):
+        raise ValueError('Input keys and times are different lengths.')
+    if len(q) < 2:
+        raise ValueError('Input keys needs at least two keyframes.')
+
+    i = np.clip(np.searchsorted(times, new_times, side='right') - 1, 0, len(q) - 2)
+    t = np.clip((new_times - times[i]) / (times[i+1] - times[i]), 0, 1).astype(compute, copy=False)
+
+    if method == 'slerp':
+        r = slerp_components(q[i], q[i+1], t)
+    elif method == 'squad':
+        controls = squad_control_components(q)
+        r = squad_components(q[i], controls[i], controls[i+1], q[i+1], t)
+    else:
+        raise ValueError("Input method is not 'slerp' or 'squad'.")
+    return QuaternionArray(r.reshape(-1, 4).astype(dtype, copy=False))
+
+def slerp_components(p, q, t):
+    # Unit (..., 4) components; t broadcasts against the leading dimensions
+    dot = np.sum(p * q, axis=-1)
+    # Take the shorter arc - q and -q are the same rotation
+    q = np.where((dot < 0)[..., None], -q, q)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1, 1))
+    sin_theta = np.sin(theta)
+
+    # Nearly parallel keys fall back to lerp, chosen per element without branching
+    near = sin_theta < 1e-10
+    safe = np.where(near, 1, sin_theta)
+    w0 = np.where(near, 1 - t, np.sin((1 - t) * theta) / safe)
+    w1 = np.where(near, t, np.sin(t * theta) / safe)
+
+    r = w0[..., None] * p + w1[..., None] * q
+    return r / np.sqrt(np.sum(r * r, axis=-1, keepdims=True))
+
+def squad_components(p, a, b, q, t):
+    # The inner slerps must not flip onto the shorter arc, so use slerp_direct
+    return slerp_direct(slerp_direct(p, q, t), slerp_direct(a, b, t), 2 * t * (1 - t))
+
+def slerp_direct(p, q, t):
+    # slerp without the shorter arc flip, p (p^-1 q)^t for unit p
+    rel = hamilton(conjugate_components(p), q)
+    return hamilton(p, exp_components(t[..., None] * log_components(rel)))
+
+def squad_control_components(q):
+    # Ends reuse their own key, which clamps the tangent there
+    conj = conjugate_components(q)
+    after = hamilton(conj, np.concatenate((q[1:], q[-1:])))
+    before = hamilton(conj, np.concatenate((q[:1], q[:-1])))
+    return hamilton(q, exp_components(-(log_components(after) + log_components(before)) / 4))
+
+def continuous_components(q):
+    # Flip signs so each key is on the same hemisphere as the one before it
+    if q.ndim != 2 or len(q) < 2:
+        return q
+    flips = np.sum(q[1:] * q[:-1], axis=-1) < 0
+    sign = np.concatenate(([1.0], np.where(np.cumsum(flips) % 2 == 1, -1.0, 1.0)))
+    return q * sign[:, None]
+
+# NumPy Interoperability
+
+def operand_components(elem):
+    # Like as_components, but NumPy arrays hold numbers (or Quaternions)
+    # elementwise, as they would for any other NumPy operand
+    if not isinstance(elem, np.ndarray):
+        return as_components(elem)
+    if elem.dtype == object:
+        q = np.array([as_components(x) for x in elem.ravel()], dtype=np.float64)
+        return q.reshape(elem.shape + (4,))
+    q = np.zeros(elem.shape + (4,))
+    q[..., 0] = elem.real
+    if np.iscomplexobj(elem):
+        q[..., 1] = elem.imag
+    return q
+
+def object_scalar(elem):
+    # 0-d object array holding elem, so NumPy loops over it like any element
+    out = np.empty((), dtype=object)
+    out[()] = elem
+    return out
+
+def array_dtype(elems):
+    # Storage dtype shared by the QuaternionArrays among elems (float64 if there
+    # are none). Mixing dtypes needs an explicit astype() first.
+    dtypes = set(x.dtype for x in elems if type(x) == QuaternionArray)
+    if len(dtypes) > 1:
+        raise TypeError('Cannot mix QuaternionArray dtypes {} - cast with astype() first.'.format(
+            ' and '.join(sorted(str(dtype) for dtype in dtypes))))
+    return dtypes.pop() if dtypes else np.dtype(np.float64)
+
+def wrap_components(q, dtype='float64'):
+    if q.ndim == 1:
+        return Quaternion(*q.tolist())
+    if q.ndim == 2:
+        return QuaternionArray(q.astype(dtype, copy=False))
+    raise ValueError('Result is not shape (N, 4).')
+
+def divide_components(p, q):
+    return hamilton(p, inverse_components(q))
+
+def rdivide_components(p, q):
+    # A number p divided by q is q^-1 p, as in Quaternion.__rtruediv__
+    return hamilton(inverse_components(q), p)
+
+def number_operand(elem):
+    # Numbers and real or complex arrays, as opposed to quaternion valued operands
+    if isinstance(elem, np.ndarray):
+        return elem.dtype != object
+    return type(elem) not in (Quaternion, QuaternionArray)
+
+def power_components(q, n):
+    return (QuaternionArray(q.reshape(-1, 4))**n)._q.reshape(q.shape)
+
+def equal_components(p, q):
+    return np.all(np.abs(p - q) <= _numeric_mode.get(_default_mode).tolerance, axis=-1)
+
+def numpy_name(func):
+    # Name of a NumPy function or ufunc, None for anything else. The tables
+    # below are keyed by name so they can be built without importing NumPy.
+    name = getattr(func, '__name__', None)
+    if name is None or getattr(np, name, None) is not func:
+        return None
+    return name
+
+# ufunc name -> (kernel on components, result is quaternion valued)
+_ufuncs = {
+    'add': (operator.add, True),
+    'subtract': (operator.sub, True),
+    'multiply': (hamilton, True),
+    'divide': (divide_components, True),
+    'negative': (operator.neg, True),
+    'positive': (operator.pos, True),
+    'conjugate': (conjugate_components, True),
+    'reciprocal': (inverse_components, True),
+    'exp': (exp_components, True),
+    'log': (log_components, True),
+    'absolute': (lambda q: np.sqrt(np.sum(q * q, axis=-1)), False),
+    'equal': (equal_components, False),
+    'not_equal': (lambda p, q: ~equal_components(p, q), False),
+}
+
+_scalar_ufuncs = {
+    'add': operator.add,
+    'subtract': operator.sub,
+    'multiply': operator.mul,
+    'divide': operator.truediv,
+    'power': operator.pow,
+    'negative': operator.neg,
+    'positive': operator.pos,
+    'conjugate': lambda q: Quaternion(q).conjugate(),
+    'reciprocal': lambda q: Quaternion(q).inverse(),
+    'exp': lambda q: Quaternion(q).exp(),
+    'log': lambda q: Quaternion(q).log(),
+    'absolute': abs,
+    'equal': operator.eq,
+    'not_equal': operator.ne,
+}
+
+def quaternion_ufunc(ufunc, method, inputs, kwargs):
+    out = kwargs.pop('out', None)
+    if out is not None:
+        if len(out) != 1 or type(out[0]) != QuaternionArray:
+            return NotImplemented
+        out = out[0]
+
+    name = numpy_name(ufunc)
+    if method == '__call__' and name in _scalar_ufuncs and out is None and not kwargs \
+            and not any(isinstance(x, (QuaternionArray, np.ndarray)) for x in inputs):
+        # Only scalars - use the Quaternion operators so the numeric mode applies
+        inputs = [x if type(x) == Quaternion else as_number(x) for x in inputs]
+        return _scalar_ufuncs[name](*inputs)
+
+    # QuaternionArrays have a single axis, so operands broadcast along one only
+    if any(isinstance(x, np.ndarray) and x.ndim > 1 for x in inputs):
+        raise TypeError('Input array is not 0-d or 1-d - a QuaternionArray has a single axis.')
+
+    # Kernels run in the compute dtype of the arrays' storage dtype
+    dtype = array_dtype(inputs + (out,))
+    compute = _compute_dtypes[dtype.name]
+
+    if method == '__call__' and name in _ufuncs and not kwargs:
+        kernel, quaternion_valued = _ufuncs[name]
+        if name == 'divide' and number_operand(inputs[0]):
+            kernel = rdivide_components
+        components = [operand_components(x).astype(compute, copy=False) for x in inputs]
+        result = kernel(*components)
+        if not quaternion_valued:
+            return result if result.ndim else result.item()
+    elif method == '__call__' and ufunc is np.power and not kwargs:
+        result = power_components(operand_components(inputs[0]).astype(compute, copy=False), inputs[1])
+    elif method == 'reduce' and ufunc in (np.add, np.multiply):
+        axis = kwargs.pop('axis', 0)
+        if axis not in (0, None) or kwargs or len(inputs) != 1:
+            return NotImplemented
+        q = operand_components(inputs[0]).astype(compute, copy=False)
+        if q.ndim != 2:
+            return NotImplemented
+        result = np.sum(q, axis=0) if ufunc is np.add else product_components(q)
+    elif method == 'accumulate' and ufunc in (np.add, np.multiply):
+        if kwargs.pop('axis', 0) != 0 or kwargs or len(inputs) != 1:
+            return NotImplemented
+        q = operand_components(inputs[0]).astype(compute, copy=False)
+        if q.ndim != 2:
+            return NotImplemented
+        result = np.cumsum(q, axis=0) if ufunc is np.add else cumprod_components(q)
+    else:
+        return NotImplemented
+
+    if out is not None:
+        out._q[...] = result
+        return out
+    return wrap_components(result, dtype)
+
+def product_components(q):
+    # Ordered product q[0] q[1] ... q[n-1], multiplying adjacent pairs in
+    # log2(n) vectorised rounds (the Hamilton product is associative)
+    if len(q) == 0:
+        return np.array([1, 0, 0, 0], dtype=q.dtype)
+    while len(q) > 1:
+        paired = hamilton(q[0:len(q)-1:2], q[1::2])
+        q = np.concatenate((paired, q[-1:])) if len(q) % 2 else paired
+    return q[0]
+
+def cumprod_components(q, reverse=False):
+    # Running products q[0] ... q[i] by a log2(n) round prefix scan - after the
+    # round with step s, row i holds the product of the last 2s rows up to i.
+    # reverse=True multiplies on the left instead, q[i] ... q[0].
+    q = np.array(q)
+    step = 1
+    while step < len(q):
+        if reverse:
+            q[step:] = hamilton(q[step:], q[:-step])
+        else:
+            q[step:] = hamilton(q[:-step], q[step:])
+        step *= 2
+    return q
+
+# NumPy function name -> implementation for QuaternionArrays
+_array_functions = {}
+
+def implements(name):
+    def register(f):
+        _array_functions[name] = f
+        return f
+    return register
+
+def single_axis(axis):
+    # QuaternionArrays have one axis, so reductions only run along it
+    if axis not in (0, None):
+        raise ValueError('Only axis=0 or axis=None is supported.')
+
+@implements('concatenate')
+def quaternion_concatenate(arrays, axis=0, out=None):
+    if axis != 0 or out is not None:
+        raise ValueError('Only axis=0 without out is supported.')
+    dtype = array_dtype(arrays)
+    return QuaternionArray(np.concatenate([QuaternionArray(x, dtype)._q for x in arrays]))
+
+@implements('copy')
+def quaternion_copy(a, *args, **kwargs):
+    return QuaternionArray(a._q.copy())
+
+@implements('sum')
+def quaternion_sum(a, axis=None):
+    single_axis(axis)
+    return np.add.reduce(a)
+
+@implements('prod')
+def quaternion_prod(a, axis=None):
+    single_axis(axis)
+    return np.multiply.reduce(a)
+
+@implements('cumsum')
+def quaternion_cumsum(a, axis=None):
+    single_axis(axis)
+    return np.add.accumulate(a)
+
+@implements('cumprod')
+def quaternion_cumprod(a, axis=None):
+    single_axis(axis)
+    return np.multiply.accumulate(a)
+
+@implements('shape')
+def quaternion_shape(a):
+    return (len(a),)
+
+@implements('size')
+def quaternion_size(a, axis=None):
+    single_axis(axis)
+    return len(a)
+
+# Streaming
+
+def integrate_angular_velocity(chunks, q0=None, dt=None, frame='body', renormalize_every=1):
+    # Integrate angular rates into orientations, one chunk at a time.
+    # chunks yields ((N, 3) rates in rad/s, (N,) timestamps in s) pairs, or just
+    # rates if a fixed sample period dt is given. Yields a QuaternionArray of the
+    # orientation at each sample; q0 (default identity) is the orientation at the
+    # first sample. Each rate is held until the next sample. Rates are in the
+    # body frame (q = q * dq) or the world frame (q = dq * q). Only the last
+    # sample is carried between chunks, so memory stays bounded by the chunk size,
+    # and the output is renormalised every renormalize_every chunks.
+    if frame not in ('body', 'world'):
+        raise ValueError("Input frame is not 'body' or 'world'.")
+    q = np.array([1.0, 0.0, 0.0, 0.0]) if q0 is None else unit_components(as_components(q0))
+    last_rate = None
+    last_time = None
+    count = 0
+
+    for chunk in chunks:
+        if dt is None:
+            rates, times = chunk
+            times = np.asarray(times, dtype=np.float64)
+        else:
+            rates = chunk
+            start = 0.0 if last_time is None else last_time + dt
+            times = start + dt * np.arange(len(rates))
+        rates = np.asarray(rates, dtype=np.float64)
+        if rates.ndim != 2 or rates.shape[1] != 3 or times.shape != (len(rates),):
+            raise ValueError('Input chunk is not (N, 3) rates with (N,) timestamps.')
+        if len(rates) == 0:
+            continue
+
+        # Rotation over each interval ending at a sample of this chunk
+        if last_time is None:
+            held, steps = rates[:-1], np.diff(times)
+            out = np.empty((len(rates), 4))
+            out[0] = q
+            fill = out[1:]
+        else:
+            held = np.concatenate((last_rate[None], rates[:-1]))
+            steps = np.diff(times, prepend=last_time)
+            out = np.empty((len(rates), 4))
+            fill = out
+
+        if len(held):
+            half_angle = np.zeros((len(held), 4))
+            half_angle[:, 1:] = held * (steps[:, None] / 2)
+            deltas = cumprod_components(exp_components(half_angle), reverse=frame == 'world')
+            fill[...] = hamilton(q, deltas) if frame == 'body' else hamilton(deltas, q)
+
+        count += 1
+        if renormalize_every and count % renormalize_every == 0:
+            out = unit_components(out)
+
+        q = out[-1]
+        last_rate = rates[-1]
+        last_time = times[-1]
+        yield QuaternionArray(out)
+
+def iter_chunks(*arrays, size=65536):
+    # Split equal length arrays (or memory maps) into chunk tuples for streaming
+    length = len(arrays[0])
+    for start in range(0, length, size):
+        chunk = tuple(array[start:start + size] for array in arrays)
+        yield chunk if len(chunk) > 1 else chunk[0]
+
+# Parallel Products
+
+def cumprod(quaternions, workers=None, executor='thread', block_size=65536, digits=None, renormalize=False):
+    # Running products q[0] q[1] ... q[i] of a QuaternionArray as a blocked
+    # parallel prefix scan: each block is scanned on its own, the block totals are
+    # chained in order, then each block is multiplied by the product of everything
+    # before it. Blocks are fixed by block_size, not by the number of workers, so
+    # the result is bit-for-bit the same as running the blocks serially
+    # (workers=1). executor is 'thread' or 'process' (blocks then live in shared
+    # memory). digits optionally rounds the result like trim(), for comparing
+    # against products taken in a different order. renormalize=True keeps long
+    # rotation chains on the unit sphere - every scanned block and carry is
+    # normalised, so drift cannot build up from one block to the next.
+    dtype = array_dtype((quaternions,))
+    q = operand_components(quaternions).astype(_compute_dtypes[dtype.name], copy=False)
+    if q.ndim != 2:
+        raise ValueError('Input is not a QuaternionArray.')
+    bounds = block_bounds(len(q), block_size)
+    workers = pool_size(workers, len(bounds))
+
+    if workers == 1:
+        result = np.array(q)
+        for bound in bounds:
+            scan_block(result, *bound, renormalize)
+        carries = block_carries(result, bounds, renormalize)
+        for bound, carry in zip(bounds[1:], carries[1:]):
+            carry_block(result, *bound, carry, renormalize)
+    elif executor == 'thread':
+        result = np.array(q)
+        with futures.ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda b: scan_block(result, *b, renormalize), bounds))
+            carries = block_carries(result, bounds, renormalize)
+            list(pool.map(lambda b, c: carry_block(result, *b, c, renormalize), bounds[1:], carries[1:]))
+    elif executor == 'process':
+        shm = shared_memory.SharedMemory(create=True, size=max(q.nbytes, 1))
+        try:
+            shared = np.ndarray(q.shape, dtype=q.dtype, buffer=shm.buf)
+            shared[...] = q
+            with futures.ProcessPoolExecutor(workers) as pool:
+                list(pool.map(shared_block, [(shm.name, q.shape, q.dtype, b, None, renormalize) for b in bounds]))
+                carries = block_carries(shared, bounds, renormalize)
+                list(pool.map(shared_block, [(shm.name, q.shape, q.dtype, b, c, renormalize)
+                                             for b, c in zip(bounds[1:], carries[1:])]))
+            result = shared.copy()
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        raise ValueError("Input executor is not 'thread' or 'process'.")
+
+    if digits is not None:
+        result = round_components(result, digits)
+    return QuaternionArray(result.astype(dtype, copy=False))
+
+def prod(quaternions, workers=None, executor='thread', block_size=65536, digits=None, renormalize=False):
+    # Ordered product q[0] q[1] ... q[n-1], with the block products in parallel.
+    # renormalize=True normalises each block product and the result.
+    q = operand_components(quaternions).astype(_compute_dtypes[array_dtype((quaternions,)).name], copy=False)
+    if q.ndim != 2:
+        raise ValueError('Input is not a QuaternionArray.')
+    bounds = block_bounds(len(q), block_size)
+    workers = pool_size(workers, len(bounds))
+    blocks = [q[start:stop] for start, stop in bounds]
+
+    if workers == 1:
+        totals = [product_components(block) for block in blocks]
+    elif executor == 'thread':
+        with futures.ThreadPoolExecutor(workers) as pool:
+            totals = list(pool.map(product_components, blocks))
+    elif executor == 'process':
+        with futures.ProcessPoolExecutor(workers) as pool:
+            totals = list(pool.map(product_components, blocks))
+    else:
+        raise ValueError("Input executor is not 'thread' or 'process'.")
+
+    totals = np.array(totals, dtype=q.dtype).reshape(-1, 4)
+    if renormalize:
+        totals = unit_components(totals)
+    result = product_components(totals)
+    if renormalize:
+        result = unit_components(result)
+    if digits is not None:
+        result = round_components(result, digits)
+    return Quaternion(*result.tolist())
+
+def block_bounds(n, block_size):
+    if type(block_size) != int or block_size < 1:
+        raise ValueError('Input block_size is not a positive int.')
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+def pool_size(workers, blocks):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if type(workers) != int or workers < 1:
+        raise ValueError('Input workers is not a positive int.')
+    return max(1, min(workers, blocks))
+
+def scan_block(q, start, stop, renormalize=False):
+    block = cumprod_components(q[start:stop])
+    q[start:stop] = unit_components(block) if renormalize else block
+
+def carry_block(q, start, stop, carry, renormalize=False):
+    block = hamilton(carry, q[start:stop])
+    q[start:stop] = unit_components(block) if renormalize else block
+
+def block_carries(q, bounds, renormalize=False):
+    # Product of every block before each block, from the scanned block totals
+    carries = [np.array([1, 0, 0, 0], dtype=q.dtype)]
+    for start, stop in bounds[:-1]:
+        carry = hamilton(carries[-1], q[stop - 1])
+        carries.append(unit_components(carry) if renormalize else carry)
+    return carries
+
+def shared_block(job):
+    # Process pool worker - scan a block, or apply its carry, in shared memory
+    name, shape, dtype, (start, stop), carry, renormalize = job
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        q = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if carry is None:
+            scan_block(q, start, stop, renormalize)
+        else:
+            carry_block(q, start, stop, carry, renormalize)
+        del q
+    finally:
+        shm.close()
+
+def round_components(q, digits):
+    # Round to digits decimal places in scientific notation, like trim()
+    q = np.asarray(q)
+    with np.errstate(divide='ignore'):
+        exponent = np.floor(np.log10(np.abs(q)))
+    exponent[~np.isfinite(exponent)] = 0
+    scale = 10.0 ** (digits - exponent)
+    return np.round(q * scale) / scale
+
+# On-disk Storage
+
+# File layout - a 64 byte little endian header, then the packed (N, 4)
+# quaternions, then (N,) float64 timestamps if the flag is set:
+#   magic 8s | version H | flags H | dtype 8s (NumPy dtype str) | count Q | padding
+_store_magic = b'QUATARR\x00'
+_store_version = 1
+_store_header = struct.Struct('<8sHH8sQ')
+_store_header_size = 64
+_store_has_timestamps = 1
+
+class QuaternionStore():
+
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'r+'):
+            raise ValueError("Input mode is not 'r' or 'r+'.")
+        with open(path, 'rb') as f:
+            header = f.read(_store_header_size)
+        if len(header) != _store_header_size or header[:8] != _store_magic:
+            raise ValueError('File is not a quaternion store.')
+        magic, version, flags, dtype, count = _store_header.unpack_from(header)
+        if version != _store_version:
+            raise ValueError('Unsupported quaternion store version {}.'.format(version))
+
+        self.path = path
+        self.mode = mode
+        self.dtype = np.dtype(dtype.rstrip(b'\x00').decode('ascii'))
+        # Memory maps - nothing is read until a slice is used
+        self._data = np.memmap(path, dtype=self.dtype, mode=mode, offset=_store_header_size, shape=(count, 4))
+        self.timestamps = None
+        if flags & _store_has_timestamps:
+            offset = _store_header_size + count * 4 * self.dtype.itemsize
+            self.timestamps = np.memmap(path, dtype='<f8', mode=mode, offset=offset, shape=(count,))
+
+    @property
+    def quaternions(self):
+        # QuaternionArray over the whole memory map, without copying
+        return QuaternionArray(self._data)
+
+    def __len__(self):
+        return self._data.shape[0]
+
+    # self[item]
+    def __getitem__(self, item):
+        if type(item) == int or isinstance(item, np.integer):
+            return Quaternion(*self._data[item].tolist())
+        return QuaternionArray(self._data[item])
+
+    def __setitem__(self, item, value):
+        self._data[item] = as_components(value)
+
+    def flush(self):
+        self._data.flush()
+        if self.timestamps is not None:
+            self.timestamps.flush()
+
+    def close(self):
+        if self.mode == 'r+':
+            self.flush()
+        self._data = None
+        self.timestamps = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return 'QuaternionStore({!r}, {} quaternions)'.format(self.path, len(self))
+
+def create_quaternions(path, count, timestamps=False, dtype='float64'):
+    # New zero filled store of count quaternions, opened for writing
+    if np.dtype(dtype).name not in _compute_dtypes:
+        raise ValueError('Input dtype is not float16, float32 or float64.')
+    dtype = np.dtype(dtype).newbyteorder('<')
+    flags = _store_has_timestamps if timestamps else 0
+    header = _store_header.pack(_store_magic, _store_version, flags, dtype.str.encode('ascii'), count)
+    size = _store_header_size + count * 4 * dtype.itemsize + (count * 8 if timestamps else 0)
+    with open(path, 'wb') as f:
+        f.write(header.ljust(_store_header_size, b'\x00'))
+        f.truncate(size)
+    return QuaternionStore(path, mode='r+')
+
+def save_quaternions(path, quaternions, timestamps=None, chunk_size=1048576, dtype=None):
+    # Write a QuaternionArray (and optional timestamps) to a new store, in the
+    # array's own dtype unless another is given
+    if dtype is None:
+        dtype = array_dtype((quaternions,))
+    q = operand_components(quaternions)
+    if q.ndim != 2:
+        raise ValueError('Input is not a QuaternionArray.')
+    if timestamps is not None and np.shape(timestamps) != (len(q),):
+        raise ValueError('Input timestamps is not shape (N,).')
+    store = create_quaternions(path, len(q), timestamps is not None, dtype)
+    with store:
+        for start in range(0, len(q), chunk_size):
+            store._data[start:start + chunk_size] = q[start:start + chunk_size]
+            if timestamps is not None:
+                store.timestamps[start:start + chunk_size] = timestamps[start:start + chunk_size]
+
+def open_quaternions(path, mode='r'):
+    return QuaternionStore(path, mode)
+
+# Text Export
+
+# Significant digits that read back to exactly the same value, per storage dtype
+_csv_digits = {
+    'float64': 17,
+    'float32': 9,
+    'float16': 5,
+}
+
+@contextmanager
+def text_file(file, mode):
+    # Opens a path, or passes an already open text file straight through
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, mode, newline='') as f:
+            yield f
+    else:
+        yield file
+
+def to_csv(file, quaternions, timestamps=None, chunk_size=65536):
+    # Write a QuaternionArray as CSV, a 'w,x,y,z' (or 't,w,x,y,z') header then one
+    # row per quaternion. Each chunk of rows is formatted by a single % operation,
+    # with no Quaternion built per row.
+    dtype = array_dtype((quaternions,))
+    q = operand_components(quaternions)
+    if q.ndim != 2:
+        raise ValueError('Input is not a QuaternionArray.')
+    if timestamps is not None and np.shape(timestamps) != (len(q),):
+        raise ValueError('Input timestamps is not shape (N,).')
+
+    row = ','.join(['%.{}g'.format(_csv_digits[dtype.name])] * 4) + '\n'
+    if timestamps is not None:
+        row = '%.17g,' + row
+    with text_file(file, 'w') as f:
+        f.write('w,x,y,z\n' if timestamps is None else 't,w,x,y,z\n')
+        for start in range(0, len(q), chunk_size):
+            chunk = q[start:start + chunk_size]
+            if timestamps is not None:
+                chunk = np.column_stack((timestamps[start:start + chunk_size], chunk))
+            f.write((row * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def from_csv(file, dtype='float64', chunk_size=65536):
+    # (QuaternionArray, timestamps or None) from a to_csv file, parsed chunk_size
+    # rows at a time by np.loadtxt
+    dtype = np.dtype(dtype)
+    if dtype.name not in _compute_dtypes:
+        raise ValueError('Input dtype is not float16, float32 or float64.')
+    with text_file(file, 'r') as f:
+        header = f.readline().strip()
+        if header not in ('w,x,y,z', 't,w,x,y,z'):
+            raise ValueError('File is not a quaternion CSV.')
+        columns = header.count(',') + 1
+        chunks = []
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            chunks.append(np.loadtxt(lines, delimiter=',', ndmin=2))
+
+    data = np.concatenate(chunks) if chunks else np.empty((0, columns))
+    if data.shape[1] != columns:
+        raise ValueError('File rows are not {} columns.'.format(columns))
+    timestamps = data[:, 0].copy() if columns == 5 else None
+    return QuaternionArray(data[:, -4:], dtype), timestamps
+
+# Lazy Expressions
+
+# lazy(q) opts into deferred evaluation - operators on it build an Expression
+# tree, which is simplified and evaluated only when a value is read. Scalar
+# trees run on component tuples (no intermediate Quaternions, same rounding as
+# the operators), array trees run block by block into one output buffer so
+# temporaries are block sized rather than whole arrays.
+
+# Rows per block when evaluating array expressions
+_lazy_block = 4096
+
+class Expression():
+
+    # op is None for a leaf (args holds the Quaternion, QuaternionArray or
+    # number), else 'add', 'sub', 'mul', 'neg', 'conjugate', 'inverse' or 'pow'
+    __slots__ = ('op', 'args')
+
+    # NumPy leaves operators to the reflected methods below instead of looping
+    # over an ndarray into an object array of Expressions
+    __array_ufunc__ = None
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+    def __add__(self, other):
+        return Expression('add', (self, lazy(other)))
+
+    def __radd__(self, other):
+        return Expression('add', (lazy(other), self))
+
+    def __sub__(self, other):
+        return Expression('sub', (self, lazy(other)))
+
+    def __rsub__(self, other):
+        return Expression('sub', (lazy(other), self))
+
+    def __mul__(self, other):
+        return Expression('mul', (self, lazy(other)))
+
+    def __rmul__(self, other):
+        return Expression('mul', (lazy(other), self))
+
+    def __truediv__(self, other):
+        return Expression('mul', (self, Expression('inverse', (lazy(other),))))
+
+    def __rtruediv__(self, other):
+        return Expression('mul', (lazy(other), Expression('inverse', (self,))))
+
+    def __neg__(self):
+        return Expression('neg', (self,))
+
+    def __pos__(self):
+        return self
+
+    def __pow__(self, n):
+        if type(n) != int and type(n) != float:
+            raise TypeError('Input n is not an int or float.')
+        return Expression('pow', (self, n))
+
+    def conjugate(self):
+        return Expression('conjugate', (self,))
+
+    def inverse(self):
+        return Expression('inverse', (self,))
+
+    def simplify(self):
+        return simplify_expression(self)
+
+    def evaluate(self):
+        # Quaternion or QuaternionArray value of the simplified tree. The arrays
+        # of the original tree set the length and dtype, even if they simplify away.
+        arrays = [leaf for leaf in expression_leaves(self) if type(leaf) == QuaternionArray]
+        node = simplify_expression(self)
+        if not arrays:
+            return Quaternion(*evaluate_scalar(node))
+        return evaluate_array(node, arrays)
+
+    # Reading anything else evaluates. Private and special names don't, so
+    # copy, pickle and hasattr() probes see a plain object.
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.evaluate(), name)
+
+    def __getitem__(self, item):
+        return self.evaluate()[item]
+
+    def __len__(self):
+        return len(self.evaluate())
+
+    def __abs__(self):
+        return abs(self.evaluate())
+
+    def __eq__(self, other):
+        if type(other) == Expression:
+            other = other.evaluate()
+        return self.evaluate() == other
+
+    def __ne__(self, other):
+        if type(other) == Expression:
+            other = other.evaluate()
+        return self.evaluate() != other
+
+    __hash__ = None
+
+    def __str__(self):
+        return str(self.evaluate())
+
+    def __repr__(self):
+        if self.op is None and type(self.args[0]) == QuaternionArray:
+            return 'lazy(<{} quaternions>)'.format(len(self.args[0]))
+        if self.op is None:
+            return 'lazy({!r})'.format(self.args[0])
+        if self.op == 'pow':
+            return '({!r} ** {!r})'.format(*self.args)
+        if len(self.args) == 1:
+            return '{}({!r})'.format(self.op, self.args[0])
+        return '{}({!r}, {!r})'.format(self.op, *self.args)
+
+def lazy(value):
+    if type(value) == Expression:
+        return value
+    if not isinstance(value, (Quaternion, QuaternionArray, numbers.Number)):
+        raise TypeError('Element not a number, Quaternion or QuaternionArray.')
+    return Expression(None, (value,))
+
+def expression_leaves(node):
+    if node.op is None:
+        yield node.args[0]
+    else:
+        for arg in node.args:
+            if type(arg) == Expression:
+                yield from expression_leaves(arg)
+
+def same_expression(x, y):
+    # Structural equality, with leaves compared by identity (numbers by value)
+    if x.op != y.op or len(x.args) != len(y.args):
+        return False
+    if x.op is None:
+        p, q = x.args[0], y.args[0]
+        if isinstance(p, numbers.Number) and isinstance(q, numbers.Number):
+            return type(p) == type(q) and p == q
+        return p is q
+    return all(same_expression(p, q) if type(p) == Expression else p == q
+               for p, q in zip(x.args, y.args))
+
+def is_one(node):
+    return node.op is None and isinstance(node.args[0], numbers.Number) and node.args[0] == 1
+
+def is_zero(node):
+    return node.op is None and isinstance(node.args[0], numbers.Number) and node.args[0] == 0
+
+def simplify_expression(node):
+    # Rewrites (assuming invertible quaternions, as the identities need):
+    #   --x, conj(conj(x)), inv(inv(x)) -> x
+    #   x + 0, 0 + x, x - 0 -> x
+    #   products are flattened, adjacent x x^-1 and x^-1 x cancel, factors of 1
+    #   drop, and runs of conjugates or inverses merge into one, e.g.
+    #   conj(a) conj(b) -> conj(b a), inv(a) inv(b) -> inv(b a)
+    if node.op is None:
+        return node
+    if node.op == 'pow':
+        return Expression('pow', (simplify_expression(node.args[0]), node.args[1]))
+    args = tuple(simplify_expression(arg) for arg in node.args)
+
+    if node.op in ('neg', 'conjugate', 'inverse'):
+        if args[0].op == node.op:
+            return args[0].args[0]
+        return Expression(node.op, args)
+    if node.op == 'add':
+        if is_zero(args[1]):
+            return args[0]
+        if is_zero(args[0]):
+            return args[1]
+        return Expression('add', args)
+    if node.op == 'sub':
+        if is_zero(args[1]):
+            return args[0]
+        return Expression('sub', args)
+
+    # Cancel inverse pairs with a stack over the flattened factors
+    factors = []
+    for factor in product_factors(args[0]) + product_factors(args[1]):
+        if factors and (same_expression(Expression('inverse', (factor,)), factors[-1])
+                        or same_expression(factor, Expression('inverse', (factors[-1],)))):
+            factors.pop()
+        elif not is_one(factor):
+            factors.append(factor)
+
+    # Merge runs of conjugates (or inverses) - both reverse the order of a product
+    merged = []
+    for factor in factors:
+        if merged and factor.op in ('conjugate', 'inverse') and merged[-1][0] == factor.op:
+            merged[-1][1].append(factor.args[0])
+        else:
+            merged.append((factor.op, [factor.args[0]] if factor.op in ('conjugate', 'inverse') else [factor]))
+    factors = []
+    for op, run in merged:
+        if op in ('conjugate', 'inverse') and len(run) > 1:
+            factors.append(Expression(op, (build_product(run[::-1]),)))
+        elif op in ('conjugate', 'inverse'):
+            factors.append(Expression(op, (run[0],)))
+        else:
+            factors.extend(run)
+
+    if not factors:
+        return lazy(1)
+    return build_product(factors)
+
+def product_factors(node):
+    if node.op == 'mul':
+        return product_factors(node.args[0]) + product_factors(node.args[1])
+    return [node]
+
+def build_product(factors):
+    node = factors[0]
+    for factor in factors[1:]:
+        node = Expression('mul', (node, factor))
+    return node
+
+def evaluate_scalar(node):
+    # Raw components of a tree of Quaternions and numbers, rounded exactly as
+    # the Quaternion operators would round them
+    if node.op is None:
+        value = node.args[0]
+        if type(value) == Quaternion:
+            return value._q
+        return Quaternion(as_number(value))._q
+    if node.op == 'pow':
+        return (Quaternion(*evaluate_scalar(node.args[0])) ** node.args[1])._q
+
+    if node.op == 'mul':
+        # An inverse feeding a product is the / operator, which trims the inverse
+        args = [inverse_of(*trimmed(evaluate_scalar(arg.args[0]))) if arg.op == 'inverse'
+                else evaluate_scalar(arg) for arg in node.args]
+        return product(*trimmed(args[0]), *trimmed(args[1]))
+    args = [evaluate_scalar(arg) for arg in node.args]
+    if node.op == 'add':
+        a1, b1, c1, d1 = trimmed(args[0])
+        a2, b2, c2, d2 = trimmed(args[1])
+        return a1 + a2, b1 + b2, c1 + c2, d1 + d2
+    if node.op == 'sub':
+        a1, b1, c1, d1 = trimmed(args[0])
+        a2, b2, c2, d2 = trimmed(args[1])
+        return a1 - a2, b1 - b2, c1 - c2, d1 - d2
+    a, b, c, d = args[0]
+    if node.op == 'neg':
+        return -a, -b, -c, -d
+    if node.op == 'conjugate':
+        return a, -b, -c, -d
+    # inverse, as Quaternion.inverse() takes it - untrimmed
+    if _numeric_mode.get(_default_mode).digits is None:
+        return exact_inverse(a, b, c, d)
+    nsi = 1/norm_squared(a, b, c, d)
+    return nsi*a, -nsi*b, -nsi*c, -nsi*d
+
+def fold_scalars(node):
+    # Replace subtrees without arrays by their (once evaluated) Quaternion
+    if node.op is None:
+        return node
+    if not any(type(leaf) == QuaternionArray for leaf in expression_leaves(node)):
+        return lazy(Quaternion(*evaluate_scalar(node)))
+    if node.op == 'pow':
+        return Expression('pow', (fold_scalars(node.args[0]), node.args[1]))
+    return Expression(node.op, tuple(fold_scalars(arg) for arg in node.args))
+
+def evaluate_array(node, arrays):
+    node = fold_scalars(node)
+    dtype = array_dtype(arrays)
+    compute = _compute_dtypes[dtype.name]
+    length = np.broadcast_shapes(*[array._q.shape[:1] for array in arrays])[0]
+
+    out = np.empty((length, 4), dtype=dtype)
+    for start in range(0, max(length, 1), _lazy_block):
+        block = slice(start, min(start + _lazy_block, length))
+        out[block] = evaluate_block(node, block, length, compute)
+    return QuaternionArray(out)
+
+def evaluate_block(node, block, length, compute):
+    # Components of rows block of an array tree
+    if node.op is None:
+        value = node.args[0]
+        if type(value) == QuaternionArray:
+            q = value._q if len(value) != length else value._q[block]
+            return q.astype(compute, copy=False)
+        return as_components(value).astype(compute, copy=False)
+    if node.op == 'pow':
+        q = evaluate_block(node.args[0], block, length, compute)
+        return power_components(np.broadcast_to(q, (block.stop - block.start, 4)), node.args[1])
+
+    args = [evaluate_block(arg, block, length, compute) for arg in node.args]
+    if node.op == 'mul':
+        return hamilton(args[0], args[1])
+    if node.op == 'add':
+        return args[0] + args[1]
+    if node.op == 'sub':
+        return args[0] - args[1]
+    if node.op == 'neg':
+        return np.negative(args[0])
+    if node.op == 'conjugate':
+        return conjugate_components(args[0])
+    return inverse_components(args[0])
+
+# Instrumentation
+
+# Quaternion methods and module functions set_instrumentation() wraps
+_instrumented_methods = ('__add__', '__radd__', '__sub__', '__rsub__', '__mul__', '__rmul__',
+                         '__truediv__', '__rtruediv__', 'inverse', '__pow__')
+_instrumented_functions = ('convert', 'test')
+# Originals of the wrapped operations while instrumentation is on, else empty
+_uninstrumented = {}
+# name -> {'calls', 'seconds', 'alloc_bytes'}, plus the current settings
+_instrumentation = {'stats': {}, 'allocations': False, 'callback': None, 'tracemalloc': False}
+_instrumentation_lock = _thread.allocate_lock()
+
+def set_instrumentation(enabled=True, allocations=False, callback=None):
+    # Swaps counting and timing wrappers in for the operations above, or the
+    # originals back, so there is no cost at all while disabled. Times include
+    # nested operations (q**5 counts its products too). allocations=True also
+    # records the bytes each call leaves allocated, through tracemalloc, which
+    # slows everything down. callback(name, seconds, alloc_bytes) runs after
+    # every call. Code that imported convert or test by name keeps the originals.
+    module = globals()
+    with _instrumentation_lock:
+        for name, original in _uninstrumented.items():
+            if name in _instrumented_functions:
+                module[name] = original
+            else:
+                setattr(Quaternion, name, original)
+        _uninstrumented.clear()
+        if _instrumentation['tracemalloc']:
+            tracemalloc.stop()
+            _instrumentation['tracemalloc'] = False
+        _instrumentation['allocations'] = enabled and allocations
+        _instrumentation['callback'] = callback if enabled else None
+        if not enabled:
+            return
+
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _instrumentation['tracemalloc'] = True
+        for name in _instrumented_methods:
+            _uninstrumented[name] = Quaternion.__dict__[name]
+            setattr(Quaternion, name, instrument('Quaternion.' + name, _uninstrumented[name]))
+        for name in _instrumented_functions:
+            _uninstrumented[name] = module[name]
+            module[name] = instrument(name, module[name])
+
+def instrumentation_stats(reset=False):
+    # Copy of the counts so far, optionally zeroing them
+    with _instrumentation_lock:
+        stats = {name: dict(entry) for name, entry in _instrumentation['stats'].items()}
+        if reset:
+            _instrumentation['stats'].clear()
+    return stats
+
+@contextmanager
+def instrumented(allocations=False, callback=None):
+    # with instrumented(): ... counts the block, then turns instrumentation off
+    set_instrumentation(True, allocations, callback)
+    try:
+        yield
+    finally:
+        set_instrumentation(False)
+
+def instrument(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        allocations = _instrumentation['allocations']
+        before = tracemalloc.get_traced_memory()[0] if allocations else 0
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            alloc_bytes = tracemalloc.get_traced_memory()[0] - before if allocations else 0
+            record_call(name, seconds, alloc_bytes)
+    return wrapper
+
+def record_call(name, seconds, alloc_bytes):
+    with _instrumentation_lock:
+        entry = _instrumentation['stats'].get(name)
+        if entry is None:
+            entry = _instrumentation['stats'][name] = {'calls': 0, 'seconds': 0.0, 'alloc_bytes': 0}
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['alloc_bytes'] += alloc_bytes
+        callback = _instrumentation['callback']
+    if callback is not None:
+        callback(name, seconds, alloc_bytes)
+
+# Rotation Averaging and Search
+
+def mean_rotation(quaternions, weights=None):
+    # Weighted mean rotation by Markley's method - the eigenvector of the largest
+    # eigenvalue of sum(w q q^T) over the unit quaternions. Being quadratic in
+    # q it ignores their signs. Returned with a non-negative scalar part.
+    q = unit_components(as_components(quaternions).astype(np.float64).reshape(-1, 4))
+    if weights is None:
+        weights = np.ones(len(q))
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape != (len(q),):
+        raise ValueError('Input weights is not shape (N,).')
+    if len(q) == 0 or np.any(weights < 0) or not np.sum(weights) > 0:
+        raise ValueError('Input weights must be non-negative with a positive sum.')
+    m = (q * weights[:, None]).T @ q
+    mean = np.linalg.eigh(m)[1][:, -1]
+    if mean[0] < 0:
+        mean = -mean
+    return Quaternion(*mean.tolist())
+
+_search_block = 2048
+
+class RotationIndex():
+
+    # KD-tree over unit quaternions for k-nearest and radius queries. Points are
+    # stored on the w >= 0 half of the sphere and every query runs for both q
+    # and -q, so q and -q are the same rotation. Distances in and out are
+    # rotation angles (as geodesic_distance); the tree itself works on the
+    # matching chordal distance 2 sin(angle/4), which orders them the same way.
+    # Queries run for all query points at once, level by level through the tree.
+
+    def __init__(self, quaternions, leaf_size=32):
+        if type(leaf_size) != int or leaf_size < 1:
+            raise ValueError('Input leaf_size is not a positive int.')
+        q = unit_components(as_components(quaternions).astype(np.float64).reshape(-1, 4))
+        q = np.where(q[:, :1] < 0, -q, q)
+        self.leaf_size = leaf_size
+
+        # Nodes cover contiguous ranges of the points once sorted into order
+        order = np.arange(len(q))
+        nodes = {'start': [], 'stop': [], 'lo': [], 'hi': [], 'dim': [], 'split': [], 'left': [], 'right': []}
+
+        def build(start, stop):
+            node = len(nodes['start'])
+            points = q[order[start:stop]]
+            for key, value in (('start', start), ('stop', stop), ('dim', 0), ('split', 0.0), ('left', -1), ('right', -1)):
+                nodes[key].append(value)
+            nodes['lo'].append(points.min(axis=0) if len(points) else np.zeros(4))
+            nodes['hi'].append(points.max(axis=0) if len(points) else np.zeros(4))
+            if stop - start > leaf_size:
+                dim = int(np.argmax(nodes['hi'][node] - nodes['lo'][node]))
+                mid = (start + stop) // 2
+                order[start:stop] = order[start:stop][np.argpartition(points[:, dim], mid - start)]
+                nodes['dim'][node] = dim
+                nodes['split'][node] = q[order[mid], dim]
+                nodes['left'][node] = build(start, mid)
+                nodes['right'][node] = build(mid, stop)
+            return node
+
+        build(0, len(q))
+        self._order = order
+        self._points = q[order]
+        for key, values in nodes.items():
+            setattr(self, '_' + key, np.array(values))
+
+    def __len__(self):
+        return len(self._points)
+
+    def query(self, quaternions, k=1):
+        # (angles, indices) of the k nearest indexed rotations to each query,
+        # nearest first - (M, k) arrays, or (k,) for a single Quaternion
+        if type(k) != int or not 0 < k <= len(self):
+            raise ValueError('Input k is not between 1 and the number of indexed quaternions.')
+        queries = self._queries(quaternions)
+        found = [self._nearest(queries[i:i + _search_block], k) for i in range(0, len(queries), _search_block)]
+        angles = np.concatenate([dist for dist, point in found]) if found else np.zeros((0, k))
+        indices = np.concatenate([point for dist, point in found]) if found else np.zeros((0, k), dtype=np.int64)
+        angles = 4*np.arcsin(np.minimum(angles / 2, 1))
+        indices = self._order[indices]
+        if type(quaternions) == Quaternion:
+            return angles[0], indices[0]
+        return angles, indices
+
+    def query_radius(self, quaternions, angle, return_distance=False):
+        # Indices (and optionally angles) of the indexed rotations within angle of
+        # each query, nearest first - a list with one array per query, or a
+        # single array for a single Quaternion
+        queries = self._queries(quaternions)
+        radius = 2*np.sin(min(max(angle, 0.0), np.pi) / 4)
+        indices, angles = [], []
+        for i in range(0, len(queries), _search_block):
+            block = queries[i:i + _search_block]
+            owner, point, dist = self._within(block, np.full(len(block), radius))
+            bounds = group_starts(owner, len(block))[1:-1]
+            indices.extend(np.split(self._order[point], bounds))
+            angles.extend(np.split(4*np.arcsin(np.minimum(dist / 2, 1)), bounds))
+        if type(quaternions) == Quaternion:
+            indices, angles = indices[0], angles[0]
+        return (indices, angles) if return_distance else indices
+
+    def _queries(self, quaternions):
+        q = unit_components(as_components(quaternions).astype(np.float64).reshape(-1, 4))
+        return np.where(q[:, :1] < 0, -q, q)
+
+    def _nearest(self, queries, k):
+        # (chordal distances, sorted positions) of the k nearest points to a
+        # block of queries
+
+        # Bound the k-th distance by the k-th nearest point in the smallest
+        # subtree around the query that holds at least k points
+        node = np.zeros(len(queries), dtype=np.int64)
+        rows = np.arange(len(queries))
+        while True:
+            left = self._left[node]
+            side = np.where(queries[rows, self._dim[node]] < self._split[node], left, self._right[node])
+            side = np.maximum(side, 0)
+            descend = (left >= 0) & (self._stop[side] - self._start[side] >= k)
+            if not np.any(descend):
+                break
+            node = np.where(descend, side, node)
+        point = self._start[node][:, None] + np.arange((self._stop[node] - self._start[node]).max())
+        points = self._points[np.minimum(point, len(self) - 1)]
+        dist = np.minimum(np.linalg.norm(points - queries[:, None], axis=-1), np.linalg.norm(points + queries[:, None], axis=-1))
+        dist[point >= self._stop[node][:, None]] = np.inf
+        # Widened slightly, as _within measures distances with different rounding
+        radius = np.partition(dist, k - 1, axis=1)[:, k - 1] * (1 + 1e-12)
+
+        # Everything within the bound, of which the first k per query are nearest.
+        # Any query still short of k hits is searched again without a bound.
+        while True:
+            owner, point, dist = self._within(queries, radius)
+            starts = group_starts(owner, len(queries))
+            short = np.diff(starts) < k
+            if not np.any(short):
+                break
+            radius[short] = np.inf
+        take = (starts[:-1, None] + np.arange(k)).ravel()
+        return dist[take].reshape(-1, k), point[take].reshape(-1, k)
+
+    def _within(self, queries, radius):
+        # (query, sorted position, chordal distance) of every point within
+        # radius of each query or its negation, sorted by query then distance
+        both = np.concatenate((queries, -queries))
+        radius = np.concatenate((radius, radius))
+        qi = np.arange(len(both))
+        node = np.zeros(len(both), dtype=np.int64)
+        leaf_q, leaf_node = [], []
+        while len(qi) and len(self):
+            # Drop subtrees whose bounding box is beyond the radius
+            x = both[qi]
+            gap = np.maximum(self._lo[node] - x, 0) + np.maximum(x - self._hi[node], 0)
+            keep = np.einsum('ij,ij->i', gap, gap) <= radius[qi]**2
+            qi, node = qi[keep], node[keep]
+            leaf = self._left[node] < 0
+            leaf_q.append(qi[leaf])
+            leaf_node.append(node[leaf])
+            qi, node = qi[~leaf], node[~leaf]
+            qi = np.concatenate((qi, qi))
+            node = np.concatenate((self._left[node], self._right[node]))
+
+        leaf_q = np.concatenate(leaf_q) if leaf_q else np.zeros(0, dtype=np.int64)
+        leaf_node = np.concatenate(leaf_node) if leaf_node else np.zeros(0, dtype=np.int64)
+        rows, point = expand_ranges(self._start[leaf_node], self._stop[leaf_node])
+        qidx = leaf_q[rows]
+        dist = np.linalg.norm(self._points[point] - both[qidx], axis=-1)
+        keep = dist <= radius[qidx]
+        return nearest_pairs(qidx[keep] % len(queries), point[keep], dist[keep])
+
+def expand_ranges(starts, stops):
+    # (row, i) for every i in range(starts[row], stops[row])
+    counts = stops - starts
+    rows = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, starts[rows] + offsets
+
+def nearest_pairs(owner, point, dist):
+    # Keep the nearer of duplicate (owner, point) pairs (a point found from both
+    # q and -q), sorted by owner then distance
+    order = np.lexsort((dist, point, owner))
+    owner, point, dist = owner[order], point[order], dist[order]
+    first = np.ones(len(owner), dtype=bool)
+    first[1:] = (owner[1:] != owner[:-1]) | (point[1:] != point[:-1])
+    owner, point, dist = owner[first], point[first], dist[first]
+    order = np.lexsort((dist, owner))
+    return owner[order], point[order], dist[order]
+
+def group_starts(owner, n):
+    # Offsets of each owner's run in a sorted owner array, plus the end
+    return np.searchsorted(owner, np.arange(n + 1))
@@ -0,0 +1,210 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from QuaternionClass import Quaternion, QuaternionArray, convert, test, numeric_mode, to_csv, get_backend
+
+# Benchmarks for the Quaternion hot paths
+#
+#   python benchmark_quaternion.py                 run and print results
+#   python benchmark_quaternion.py --save          also write them to the baseline file
+#   python benchmark_quaternion.py --compare       flag regressions against the baseline
+#
+# Size 1 times the scalar Quaternion operators (in the default rounded mode and
+# in exact mode), larger sizes time the same operation on a QuaternionArray.
+# convert() and test() are scalar helpers so only run at size 1, csv (to_csv into
+# memory) is batch only. --dtypes adds
+# the batch cases for float32 and float16 storage, named e.g. mul[1000,float32].
+# import times importing the module (the scalar core, without NumPy) in a fresh
+# interpreter.
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+DEFAULT_SIZES = (1, 1000, 1000000)
+DTYPES = ('float64', 'float32', 'float16')
+
+OPERATIONS = ('mul', 'add', 'inverse', 'pow', 'abs', 'convert', 'test', 'csv', 'import')
+
+def scalar_case(op):
+    q = Quaternion(1.1, 2.2, 3.3, 4.4)
+    r = Quaternion(5.0, -6.0, 7.0, -8.0)
+    return {
+        'mul': lambda: q * r,
+        'add': lambda: q + r,
+        'inverse': lambda: q.inverse(),
+        'pow': lambda: q ** 5,
+        'abs': lambda: abs(q),
+        'convert': lambda: convert(q),
+        'test': lambda: test(q, r),
+    }.get(op)
+
+def batch_case(op, size, dtype='float64'):
+    rng = np.random.default_rng(0)
+    A = QuaternionArray(rng.normal(size=(size, 4)), dtype)
+    B = QuaternionArray(rng.normal(size=(size, 4)), dtype)
+    return {
+        'mul': lambda: A * B,
+        'add': lambda: A + B,
+        'inverse': lambda: A.inverse(),
+        'pow': lambda: A ** 5,
+        'abs': lambda: abs(A),
+        'csv': lambda: to_csv(io.StringIO(), A),
+    }.get(op)
+
+def cases(ops, sizes, dtypes=('float64',)):
+    # name -> (callable, quaternions per call, exact mode)
+    found = {}
+    for op in ops:
+        for size in sizes:
+            if size == 1:
+                func = scalar_case(op)
+                if func is not None:
+                    found['{}[1]'.format(op)] = (func, 1, False)
+                    found['{}[1,exact]'.format(op)] = (func, 1, True)
+                continue
+            for dtype in dtypes:
+                func = batch_case(op, size, dtype)
+                if func is None:
+                    continue
+                if dtype == 'float64':
+                    found['{}[{}]'.format(op, size)] = (func, size, False)
+                else:
+                    found['{}[{},{}]'.format(op, size, dtype)] = (func, size, False)
+    return found
+
+def time_case(func, min_time, repeat):
+    # Best of repeat runs, each long enough to cover min_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def import_time(repeat):
+    # Best of repeat imports, each in a fresh interpreter
+    code = ('import sys, time; sys.path.insert(0, {!r}); start = time.perf_counter(); '
+            'import QuaternionClass; print(time.perf_counter() - start)').format(os.path.dirname(os.path.abspath(__file__)))
+    return min(float(subprocess.check_output([sys.executable, '-c', code])) for i in range(repeat))
+
+def allocations(func):
+    # Peak bytes allocated while one call runs, result included
+    func()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak - before
+
+def run(ops=OPERATIONS, sizes=DEFAULT_SIZES, min_time=0.2, repeat=3, dtypes=('float64',)):
+    results = {}
+    for name, (func, size, exact) in cases(ops, sizes, dtypes).items():
+        if exact:
+            with numeric_mode(None):
+                seconds = time_case(func, min_time, repeat)
+                alloc = allocations(func)
+        else:
+            seconds = time_case(func, min_time, repeat)
+            alloc = allocations(func)
+        results[name] = {
+            'seconds_per_call': seconds,
+            'ops_per_sec': size / seconds,
+            'alloc_bytes_per_op': alloc / size,
+        }
+    if 'import' in ops:
+        seconds = import_time(max(repeat, 5))
+        results['import'] = {'seconds_per_call': seconds, 'ops_per_sec': 1 / seconds, 'alloc_bytes_per_op': 0.0}
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'backend': get_backend(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+def compare(results, baseline, threshold=0.2):
+    # Regressions - throughput down or allocations up by more than threshold
+    regressions = []
+    for name, now in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if now['ops_per_sec'] < before['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, 'ops_per_sec', before['ops_per_sec'], now['ops_per_sec']))
+        if now['alloc_bytes_per_op'] > before['alloc_bytes_per_op'] * (1 + threshold) + 1:
+            regressions.append((name, 'alloc_bytes_per_op', before['alloc_bytes_per_op'], now['alloc_bytes_per_op']))
+    return regressions
+
+def report(results, baseline=None):
+    lines = ['{:<26} {:>16} {:>16} {:>10}'.format('benchmark', 'ops/sec', 'bytes/op', 'change')]
+    for name, now in results['results'].items():
+        change = ''
+        if baseline is not None and name in baseline['results']:
+            ratio = now['ops_per_sec'] / baseline['results'][name]['ops_per_sec']
+            change = '{:+.1%}'.format(ratio - 1)
+        lines.append('{:<26} {:>16,.0f} {:>16,.1f} {:>10}'.format(name, now['ops_per_sec'], now['alloc_bytes_per_op'], change))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Quaternion hot paths.')
+    parser.add_argument('--ops', nargs='+', choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES)
+    parser.add_argument('--dtypes', nargs='+', choices=DTYPES, default=('float64',), help='QuaternionArray storage dtypes')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='write the results to the baseline file')
+    parser.add_argument('--compare', action='store_true', help='exit 1 if any result regressed against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed fractional slowdown')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            parser.error('no baseline at {}, run with --save first'.format(args.baseline))
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run(args.ops, args.sizes, args.min_time, args.repeat, args.dtypes)
+    print(report(results, baseline))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, before, now in regressions:
+            print('REGRESSION {} {}: {:,.1f} -> {:,.1f}'.format(name, metric, before, now))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
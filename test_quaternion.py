@@ -1,6 +1,29 @@
+import ast
+import copy
+import importlib.util
+import io
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from quaternion import Quaternion as qt
+from quaternion import QuaternionArray as qa
+from quaternion import numeric_mode, get_numeric_mode, set_numeric_mode
+from quaternion import set_cache, cache_info, clear_cache
+from quaternion import get_backend
+from quaternion import lazy
+from quaternion import set_instrumentation, instrumentation_stats, instrumented
+from quaternion import slerp, squad, squad_controls, interpolate
+from quaternion import integrate_angular_velocity, iter_chunks
+from quaternion import cumprod, prod
+from quaternion import geodesic_distance, chordal_distance
+from quaternion import mean_rotation, RotationIndex
+from quaternion import save_quaternions, open_quaternions, create_quaternions
+from quaternion import to_csv, from_csv
 
 class TestQuaternion(unittest.TestCase):
 
@@ -13,12 +36,6 @@ class TestQuaternion(unittest.TestCase):
         self.q3 = qt(1e-14, 1e-15, 1e-16, 1e-17)
         self.q4 = qt(1e14, 1e15, 1e16, 1e17)
 
-        # Improper quaternions
-        self.q5 = qt((1,2,3,4))
-        self.q6 = qt([1,2,3,4])
-        self.q7 = qt(1,'a',3,4)
-        self.q8 = qt('hello')
-
         # For Arithmetic
         self.q = qt(1,2,3,4)
         self.r = qt(5,6,7,8)
@@ -35,18 +52,270 @@ class TestQuaternion(unittest.TestCase):
         self.assertEqual(qt.quaternion_test(self.q4), None)
         self.assertEqual(qt.quaternion_test(self.q0), None)
 
-        # Test non-tuples
+        # Improper quaternions are rejected by the constructor
         with self.assertRaises(TypeError):
-            qt.quaternion_test(self.q5)
+            qt((1,2,3,4))
         with self.assertRaises(TypeError):
-            qt.quaternion_test(self.q6)
+            qt([1,2,3,4])
         with self.assertRaises(TypeError):
-            qt.quaternion_test(self.q7)
+            qt(1,'a',3,4)
         with self.assertRaises(TypeError):
-            qt.quaternion_test(self.q8)
-        
+            qt('hello')
+        with self.assertRaises(TypeError):
+            qt(True,0,0,0)
+
         # No need to test wrong length tuple
-        # as constructor ensures tuple is length 4
+        # as constructor takes exactly four components
+
+    def test_slots(self):
+        # Four float fields and no instance __dict__
+        self.assertFalse(hasattr(self.q1, '__dict__'))
+        self.assertEqual(self.q1._q, (1.0,2.0,3.0,4.0))
+        self.assertEqual(type(self.q1.real), float)
+        self.assertEqual(qt(self.q2)._q, self.q2._q)
+        self.assertEqual(qt(1+2j, 3+4j)._q, (1.0,2.0,3.0,4.0))
+
+    def test_str(self):
+        self.assertEqual(str(self.q1), '(1.0+2.0i+3.0j+4.0k)')
+        self.assertEqual(str(qt(-1.5,-2,0,1e20)), '(-1.5-2.0i+0.0j+1e+20k)')
+        self.assertEqual(str(qt(0,-0.0,0,0)), '(0.0-0.0i+0.0j+0.0k)')
+        self.assertEqual(repr(self.q2), str(self.q2))
+        # Cached after the first call
+        self.assertIs(str(self.q2), str(self.q2))
+        self.assertEqual(str(qa([self.q1, -self.q1])), '[(1.0+2.0i+3.0j+4.0k), (-1.0-2.0i-3.0j-4.0k)]')
+
+    def test_hash(self):
+        # Immutable
+        with self.assertRaises(AttributeError):
+            self.q1._a = 5
+        with self.assertRaises(AttributeError):
+            self.q1.real = 5
+        with self.assertRaises(AttributeError):
+            del self.q1._b
+        # Calling __init__ again cannot rewrite the value (or leave str stale)
+        q = qt(1,2,3,4)
+        h, text = hash(q), str(q)
+        q.__init__(9,9,9,9)
+        self.assertEqual(q._q, (1.0, 2.0, 3.0, 4.0))
+        self.assertEqual((hash(q), str(q)), (h, text))
+        self.assertRaises(TypeError, qt, 1.5, 2.5, 'a', 4.5)
+
+        # Hash agrees with ==, and against numbers that trimming leaves unchanged
+        self.assertEqual(hash(self.q1), hash(qt(1.0,2.0,3.0,4.0)))
+        self.assertEqual(hash(qt(3)), hash(3))
+        self.assertEqual(hash(qt(1,2)), hash(1+2j))
+        self.assertEqual(len({self.q1, qt(1,2,3,4), self.q2, qt(self.q2)}), 2)
+        self.assertEqual({self.q2: 'cached'}[qt(1.1,2.2,3.3,4.4)], 'cached')
+        # Components equal after trimming hash equal
+        self.assertEqual(qt(1.000000000000001), qt(1))
+        self.assertEqual(hash(qt(1.000000000000001)), hash(qt(1)))
+        # A number trimming changes compares equal but hashes as itself
+        self.assertEqual(qt(0.1+0.2), 0.1+0.2)
+        self.assertEqual(hash(qt(0.1+0.2)), hash(qt(0.3)))
+        self.assertNotEqual(hash(qt(0.1+0.2)), hash(0.1+0.2))
+        # Unrelated objects compare unequal instead of raising
+        self.assertFalse(self.q1 == None)
+        self.assertTrue(self.q1 != 'a')
+        self.assertIn(self.q1, [None, 'a', self.q1])
+        self.assertNotIn(self.q1, {None: 1, 'a': 2})
+
+        # q and -q are the same rotation
+        self.assertEqual(self.q1.rotation_key(), (-self.q1).rotation_key())
+        self.assertEqual(self.q1.rotation_key(), (2*self.q1).rotation_key())
+        self.assertEqual(self.q1.rotation_key(1e-3), qt(1,2,3,4.000001).rotation_key(1e-3))
+        self.assertNotEqual(self.q1.rotation_key(), qt(1,2,3,4.000001).rotation_key())
+        self.assertEqual(qt(0,0,-1,0).rotation_key(1e-3), (0, 0, 1000, 0))
+        self.assertRaises(ZeroDivisionError, self.q0.rotation_key)
+
+        self.assertEqual(pickle.loads(pickle.dumps(self.q2)), self.q2)
+
+    def test_cache(self):
+        zeros = (qt(1,0.0,2,0), qt(1,-0.0,2,0))
+        expected = (self.q2.inverse(), self.q2**5, self.q2**5.0, self.q2**-2, self.q2.matrix, self.q2.to_rotation_matrix(),
+                    [str(q.inverse()) for q in zeros])
+        set_cache(4)
+        try:
+            clear_cache()
+            for i in range(3):
+                self.assertEqual(self.q2.inverse(), expected[0])
+                self.assertEqual(self.q2**5, expected[1])
+                self.assertEqual(self.q2**5.0, expected[2])
+                self.assertEqual(self.q2**-2, expected[3])
+            info = cache_info()
+            self.assertEqual(info['maxsize'], 4)
+            self.assertEqual(info['size'], 4)
+            # q**-2 also hits the cached inverse() on its first call
+            self.assertEqual(info['hits'], 9)
+
+            # Least recently used entries are dropped
+            self.assertTrue(np.array_equal(self.q2.matrix, expected[4]))
+            self.assertEqual(cache_info()['size'], 4)
+            # Cached arrays are copied out
+            self.q2.matrix[0, 0] = 99
+            self.q2.to_rotation_matrix()[:] = 0
+            self.assertTrue(np.array_equal(self.q2.matrix, expected[4]))
+            self.assertTrue(np.array_equal(self.q2.to_rotation_matrix(), expected[5]))
+
+            # The numeric mode is part of the key
+            with numeric_mode(None):
+                exact = self.q2**5
+            self.assertNotEqual(exact._q, expected[1]._q)
+            self.assertEqual(self.q2**5, expected[1])
+
+            # Keys are bit exact, so a cached 0.0 never answers for -0.0
+            self.assertEqual([str(q.inverse()) for q in zeros], expected[6])
+
+            # Threads share the cache safely
+            with ThreadPoolExecutor(4) as pool:
+                results = list(pool.map(lambda n: qt(1,2,3,n % 5)**3, range(200)))
+            self.assertEqual(results, [qt(1,2,3,n % 5)*qt(1,2,3,n % 5)*qt(1,2,3,n % 5) for n in range(200)])
+        finally:
+            set_cache(None)
+        self.assertEqual(cache_info()['size'], 0)
+        self.assertRaises(ValueError, set_cache, -1)
+
+    def test_backend(self):
+        # The suite runs on either backend (QUATERNION_BACKEND=python or numba)
+        self.assertIn(get_backend(), ('python', 'numba'))
+        with numeric_mode(None):
+            self.assertEqual((self.q1*self.q2)._q, (1*1.1 - 2*2.2 - 3*3.3 - 4*4.4,
+                                                    1*2.2 + 2*1.1 + 3*4.4 - 4*3.3,
+                                                    1*3.3 - 2*4.4 + 3*1.1 + 4*2.2,
+                                                    1*4.4 + 2*3.3 - 3*2.2 + 4*1.1))
+            self.assertEqual(abs(self.q1), 30**0.5)
+            self.assertEqual(self.q1.inverse()._q, (1/30, -2/30, -3/30, -4/30))
+            self.assertRaises(ZeroDivisionError, self.q0.inverse)
+        points = np.random.default_rng(6).normal(size=(5, 3))
+        np.testing.assert_allclose([self.q2.rotate(v) for v in points], self.q2.rotate_points(points), atol=1e-14)
+        self.assertRaises(ZeroDivisionError, self.q0.rotate, (1, 0, 0))
+
+    @unittest.skipIf(importlib.util.find_spec('numba') is None, 'Numba is not installed')
+    def test_numba_backend(self):
+        # Forces the compiled kernels, in rounded and exact mode, against the Python ones
+        code = '\n'.join([
+            'from {} import Quaternion, get_backend, numeric_mode, exact_product'.format(qt.__module__),
+            'p, q = Quaternion(1.1,2.2,3.3,4.4), Quaternion(-0.5,0.25,3,1e-3)',
+            'def run(): return [*(p*q)._q, *(p/q)._q, abs(q), *q.inverse()._q, *(p**3)._q, *q.rotate((1,2,3))]',
+            'rounded = run()',
+            'with numeric_mode(None): exact = run()',
+            'print(get_backend(), hasattr(exact_product, "py_func"), repr(rounded + exact))'])
+        outputs = {}
+        for backend in ('python', 'numba'):
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), QUATERNION_BACKEND=backend)
+            out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+            outputs[backend] = out.stdout.split(' ', 2)
+        self.assertEqual(outputs['python'][:2], ['python', 'False'])
+        self.assertEqual(outputs['numba'][:2], ['numba', 'True'])
+        np.testing.assert_allclose(ast.literal_eval(outputs['numba'][2]), ast.literal_eval(outputs['python'][2]), rtol=1e-14)
+
+    def test_lazy(self):
+        q, r, s, t, u = [qt(*np.random.default_rng(n).normal(size=4)) for n in range(5)]
+        lq, lr, ls, lt, lu = map(lazy, (q, r, s, t, u))
+
+        # Nothing is computed until a value is read
+        e = (lq * lr * ls.inverse()) / lt + lu
+        self.assertEqual(repr(e).count('inverse'), 2)
+        self.assertEqual(type(e.evaluate()), qt)
+        # The two inverses merge into one, so equal up to rounding
+        np.testing.assert_allclose(e.evaluate()._q, ((q * r * s.inverse()) / t + u)._q, rtol=1e-12)
+        self.assertEqual(e.real, e.evaluate().real)
+        self.assertEqual(str(e), str(e.evaluate()))
+        # Single operators round exactly like the eager ones
+        self.assertEqual((lq * lr).evaluate()._q, (q * r)._q)
+        self.assertEqual((lq / lt).evaluate()._q, (q / t)._q)
+        self.assertEqual(lt.inverse().evaluate()._q, t.inverse()._q)
+        self.assertEqual(lazy(qt(1,2,3,5)).inverse().evaluate()._q, qt(1,2,3,5).inverse()._q)
+        with numeric_mode(None):
+            self.assertEqual(lt.inverse().evaluate()._q, t.inverse()._q)
+            self.assertEqual((lq / lt).evaluate()._q, (q / t)._q)
+        self.assertEqual((lq - 2).evaluate()._q, (q - 2)._q)
+        self.assertEqual((2 / lq).evaluate(), 2 / q)
+        self.assertEqual((lq ** 3).evaluate()._q, (q ** 3)._q)
+        self.assertEqual((r * lq).evaluate()._q, (r * q)._q)
+
+        # Simplification
+        self.assertEqual(repr((lq * lr * lr.inverse()).simplify()), repr(lq))
+        self.assertEqual(repr((lr.inverse() * lr * lq).simplify()), repr(lq))
+        self.assertEqual(repr((lq * lq.inverse()).simplify()), 'lazy(1)')
+        self.assertEqual(repr(lq.conjugate().conjugate().simplify()), repr(lq))
+        self.assertEqual(repr((-(-lq) + 0).simplify()), repr(lq))
+        self.assertEqual(repr((lq.conjugate() * lr.conjugate()).simplify()), repr((lr * lq).conjugate()))
+        self.assertEqual(repr((lq.inverse() * lr.inverse()).simplify()), repr((lr * lq).inverse()))
+        chain = lq * lr.conjugate() * ls.conjugate() / lt / lu
+        expected = q * r.conjugate() * s.conjugate() / t / u
+        np.testing.assert_allclose(chain.evaluate()._q, expected._q, rtol=1e-12)
+        with numeric_mode(None):
+            np.testing.assert_allclose(chain.evaluate()._q, (q * r.conjugate() * s.conjugate() / t / u)._q, rtol=1e-12)
+
+        self.assertRaises(TypeError, lazy, 'q')
+        self.assertRaises(ZeroDivisionError, (lq / self.q0).evaluate)
+        # Private names don't evaluate, so copies, pickles and probes work
+        self.assertFalse(hasattr(lq / self.q0, '__array_interface__'))
+        for e in (copy.copy(chain), copy.deepcopy(chain), pickle.loads(pickle.dumps(chain))):
+            self.assertEqual(repr(e), repr(chain))
+            self.assertEqual(e.evaluate()._q, chain.evaluate()._q)
+        # NumPy arrays don't turn into object arrays of Expressions
+        self.assertRaises(TypeError, lambda: np.array([1., 2.]) * lq)
+        self.assertRaises(TypeError, lambda: np.add(lq, np.array([1., 2.])))
+
+    def test_instrumentation(self):
+        mul = qt.__mul__
+        calls = []
+        instrumentation_stats(reset=True)
+        with instrumented(allocations=True, callback=lambda *call: calls.append(call)):
+            self.assertIsNot(qt.__mul__, mul)
+            for i in range(5):
+                self.q1 * self.q2
+                self.q1 + 1
+                self.q2 ** 3
+                self.q2.inverse()
+        # Originals are back, so nothing is counted once disabled
+        self.assertIs(qt.__mul__, mul)
+        self.q1 * self.q2
+
+        stats = instrumentation_stats(reset=True)
+        # q**3 counts its two products as well
+        self.assertEqual(stats['Quaternion.__mul__']['calls'], 15)
+        self.assertEqual(stats['Quaternion.__add__']['calls'], 5)
+        self.assertEqual(stats['Quaternion.__pow__']['calls'], 5)
+        self.assertEqual(stats['Quaternion.inverse']['calls'], 5)
+        self.assertGreater(stats['Quaternion.__pow__']['seconds'], 0)
+        self.assertGreater(stats['Quaternion.__mul__']['alloc_bytes'], 0)
+        self.assertEqual(len(calls), 30)
+        self.assertEqual(instrumentation_stats(), {})
+
+        set_instrumentation()
+        try:
+            self.assertEqual(self.q1 * self.q2, qt(-30.8,4.4,6.6,8.8))
+            self.assertEqual(instrumentation_stats()['Quaternion.__mul__']['alloc_bytes'], 0)
+        finally:
+            set_instrumentation(False)
+        instrumentation_stats(reset=True)
+
+    def test_normalize(self):
+        self.assertEqual(self.q1.norm(), abs(self.q1))
+        self.assertEqual(self.q1.norm_squared(), 30.0)
+        unit = self.q2.normalize()
+        self.assertAlmostEqual(unit.norm(), 1.0, places=15)
+        self.assertEqual(type(unit), qt)
+        self.assertEqual(self.q2, qt(1.1,2.2,3.3,4.4))
+        self.assertRaises(ZeroDivisionError, self.q0.normalize)
+
+    def test_lazy_numpy(self):
+
+        # The scalar core imports and runs without loading NumPy
+        code = ('import sys; from {} import Quaternion, convert; q = Quaternion(1,2,3,4); '
+                'q*q/q + 1 - 2j == q; abs(q); hash(q**5); q.rotate((1,0,0)); convert(2.5); '
+                'print("numpy" in sys.modules)').format(qt.__module__)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        env.pop('QUATERNION_BACKEND', None)
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), 'False')
+
+        # NumPy backed features load it on first use
+        code = code.replace('print(', 'q.matrix; print(')
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), 'True')
 
     def test_attributes(self):
         
@@ -249,11 +518,12 @@ class TestQuaternion(unittest.TestCase):
         np.testing.assert_almost_equal(self.q1**4, self.q1*self.q1*self.q1*self.q1, decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(self.q2**4, self.q2*self.q2*self.q2*self.q2, decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(self.q3**4, self.q3*self.q3*self.q3*self.q3, decimal=14, err_msg='', verbose=True)
-        np.testing.assert_almost_equal(self.q4**4, self.q4*self.q4*self.q4*self.q4, decimal=14, err_msg='', verbose=True)
+        # Square and multiply rounds differently to the left to right product, compare relative to 1e68
+        np.testing.assert_almost_equal(abs(self.q4**4 - self.q4*self.q4*self.q4*self.q4) / abs(self.q4**4), 0, decimal=14, err_msg='', verbose=True)
         # Neg n
         np.testing.assert_almost_equal(self.q1**-4, (self.q1.inverse()*self.q1.inverse()*self.q1.inverse()*self.q1.inverse()), decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(self.q2**-4, (self.q2.inverse()*self.q2.inverse()*self.q2.inverse()*self.q2.inverse()), decimal=14, err_msg='', verbose=True)
-        np.testing.assert_almost_equal(self.q3**-4, (self.q3.inverse()*self.q3.inverse()*self.q3.inverse()*self.q3.inverse()), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(abs(self.q3**-4 - self.q3.inverse()*self.q3.inverse()*self.q3.inverse()*self.q3.inverse()) / abs(self.q3**-4), 0, decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(self.q4**-4, (self.q4.inverse()*self.q4.inverse()*self.q4.inverse()*self.q4.inverse()), decimal=14, err_msg='', verbose=True)
         # n == 0
         np.testing.assert_almost_equal(self.q1**0, qt(1,0,0,0), decimal=14, err_msg='', verbose=True)
@@ -265,6 +535,62 @@ class TestQuaternion(unittest.TestCase):
         with self.assertRaises(ZeroDivisionError):
             self.q0**-4
 
+        # Large n needs only log(n) products
+        z = qt(np.cos(0.001),0,0,np.sin(0.001))
+        np.testing.assert_almost_equal(z**1000, qt(np.cos(1),0,0,np.sin(1)), decimal=12, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(z**-1000, qt(np.cos(1),0,0,-np.sin(1)), decimal=12, err_msg='', verbose=True)
+
+    def test_pow_real(self):
+        # Fractional powers through the polar form
+        np.testing.assert_almost_equal(self.q1**0.5 * self.q1**0.5, self.q1, decimal=13, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(self.q2**2.0, self.q2**2, decimal=13, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(self.q2**-1.0, self.q2.inverse(), decimal=13, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(qt(-4,0,0,0)**0.5, qt(0,2,0,0), decimal=14, err_msg='', verbose=True)
+        self.assertEqual(self.q0**0.5, self.q0)
+        with self.assertRaises(ZeroDivisionError):
+            self.q0**-0.5
+        with self.assertRaises(TypeError):
+            self.q1**'2'
+
+    def test_exp_log(self):
+        np.testing.assert_almost_equal(qt(0,np.pi,0,0).exp(), qt(-1,0,0,0), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(qt(1,0,0,0).exp(), qt(np.e,0,0,0), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(self.q1.log().exp(), self.q1, decimal=13, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(qt(-1,0,0,0).log(), qt(0,np.pi,0,0), decimal=14, err_msg='', verbose=True)
+        with self.assertRaises(ZeroDivisionError):
+            self.q0.log()
+
+    def test_numeric_mode(self):
+        # Default mode trims to 14dp, exact mode keeps every bit
+        self.assertEqual(get_numeric_mode(), {'digits': 14, 'tolerance': 0.0})
+        self.assertEqual((qt(0.1,0,0,0) * qt(3,0,0,0)).real, 0.3)
+        with numeric_mode(None):
+            self.assertEqual((qt(0.1,0,0,0) * qt(3,0,0,0)).real, 0.1*3)
+            self.assertEqual((self.q2 * self.q1).vector, (1.1*2+2.2*1+3.3*4-4.4*3, 1.1*3-2.2*4+3.3*1+4.4*2, 1.1*4+2.2*3-3.3*2+4.4*1))
+            self.assertEqual(qt(0.1,0,0,0) * 3 == qt(0.3,0,0,0), False)
+        with numeric_mode(None, 1e-12):
+            self.assertEqual(qt(0.1,0,0,0) * 3 == qt(0.3,0,0,0), True)
+            self.assertEqual(self.q1 == qt(1,2,3,4.1), False)
+            np.testing.assert_array_equal(qa([self.q1]) == qt(1,2,3,4+1e-13), [True])
+        self.assertEqual(get_numeric_mode(), {'digits': 14, 'tolerance': 0.0})
+        # Left out arguments keep their current value
+        with numeric_mode(tolerance=1e-3):
+            self.assertEqual(get_numeric_mode(), {'digits': 14, 'tolerance': 1e-3})
+            with numeric_mode(None):
+                self.assertEqual(get_numeric_mode(), {'digits': None, 'tolerance': 1e-3})
+        # A block only changes the mode of its own thread
+        q = qt(0.1+0.2)
+        keys = {q: 'trimmed'}
+        with numeric_mode(None):
+            with ThreadPoolExecutor(1) as pool:
+                self.assertEqual(pool.submit(get_numeric_mode).result(), {'digits': 14, 'tolerance': 0.0})
+                self.assertEqual(pool.submit(lambda: (qt(0.1,0,0,0) * qt(3,0,0,0)).real).result(), 0.3)
+                self.assertEqual(pool.submit(lambda: keys[qt(0.1+0.2)]).result(), 'trimmed')
+            # set_numeric_mode() inside a block lasts until the block ends
+            set_numeric_mode(10)
+            self.assertEqual(get_numeric_mode()['digits'], 10)
+        self.assertEqual(get_numeric_mode(), {'digits': 14, 'tolerance': 0.0})
+
     def test_abs(self):
         np.testing.assert_almost_equal(abs(self.q0), 0.0, decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(abs(self.q1), np.sqrt((self.q1.conjugate() * self.q1)[0]), decimal=14, err_msg='', verbose=True)
@@ -272,6 +598,9 @@ class TestQuaternion(unittest.TestCase):
         np.testing.assert_almost_equal(abs(self.q3), np.sqrt((self.q3.conjugate() * self.q3)[0]), decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(abs(self.q4), np.sqrt((self.q4.conjugate() * self.q4)[0]), decimal=14, err_msg='', verbose=True)
         np.testing.assert_almost_equal(abs(qt(2, 24, 16, 8)), 30.0, decimal=14, err_msg='', verbose=True)
+        # Plain float, so it mixes with further quaternion arithmetic
+        self.assertEqual(type(abs(self.q1)), float)
+        np.testing.assert_almost_equal(abs(self.q1 / abs(self.q1)), 1.0, decimal=14, err_msg='', verbose=True)
 
     def test_nparrays(self):
         q = qt(1,2,3,4)
@@ -350,19 +679,18 @@ class TestQuaternion(unittest.TestCase):
         np.testing.assert_array_almost_equal(((1+2j) / A), np.array([[(1+2j)/q,(1+2j)/r],[(1+2j)/s,(1+2j)/t]]), decimal=14, err_msg='', verbose=True)
 
         # Add quat, quat matrix
-        # Works when matrix is on the left with quat on right, but not other way around
-        # as the addition will belong to the quaternion if we do q + A and this is not implemented.
+        # Quaternion defers to NumPy for q + A, which loops over the object array elementwise
         np.testing.assert_array_almost_equal((A + q), np.array([[q+q,q+r],[q+s,q+t]]), decimal=14, err_msg='', verbose=True)
-        #np.testing.assert_array_almost_equal((q + A), np.array([[q+q,q+r],[q+s,q+t]]), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_array_almost_equal((q + A), np.array([[q+q,q+r],[q+s,q+t]]), decimal=14, err_msg='', verbose=True)
         # Sub quat, quat matrix
         np.testing.assert_array_almost_equal((A - q), np.array([[q-q,r-q],[s-q,t-q]]), decimal=14, err_msg='', verbose=True)
-        #np.testing.assert_array_almost_equal((q - A), np.array([[q-q,q-r],[q-s,q-t]]), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_array_almost_equal((q - A), np.array([[q-q,q-r],[q-s,q-t]]), decimal=14, err_msg='', verbose=True)
         # Mul quat, quat matrix
         np.testing.assert_array_almost_equal((A * q), np.array([[q*q,r*q],[s*q,t*q]]), decimal=14, err_msg='', verbose=True)
-        #np.testing.assert_array_almost_equal((q * A), np.array([[q*q,q*r],[q*s,q*t]]), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_array_almost_equal((q * A), np.array([[q*q,q*r],[q*s,q*t]]), decimal=14, err_msg='', verbose=True)
         # Div quat, quat matrix
         np.testing.assert_array_almost_equal((A / q), np.array([[q/q,r/q],[s/q,t/q]]), decimal=14, err_msg='', verbose=True)
-        #np.testing.assert_array_almost_equal((q / A), np.array([[q/q,q/r],[q/s,q/t]]), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_array_almost_equal((q / A), np.array([[q/q,q/r],[q/s,q/t]]), decimal=14, err_msg='', verbose=True)
 
 
         #self.q1 = qt(1,2,3,4)
@@ -370,5 +698,486 @@ class TestQuaternion(unittest.TestCase):
         #self.q3 = qt(1e-14, 1e-15, 1e-16, 1e-17)
         #self.q4 = qt(1e14, 1e15, 1e16, 1e17)
 
+class TestQuaternionArray(unittest.TestCase):
+
+    def setUp(self):
+
+        self.q = qt(1,2,3,4)
+        self.r = qt(5,6,7,8)
+        self.t = qt(9,10,11,12)
+        self.s = qt(-3,-7,-4,8)
+        self.A = qa([self.q, self.r, self.t, self.s])
+        self.B = qa([self.s, self.t, self.r, self.q])
+
+    def assertMatches(self, A, quats):
+        np.testing.assert_array_almost_equal(A._q, np.array([q._q for q in quats]), decimal=12, err_msg='', verbose=True)
+
+    def test_construction(self):
+        self.assertEqual(self.A._q.shape, (4,4))
+        self.assertEqual(self.A._q.dtype, np.float64)
+        self.assertEqual(len(qa()), 0)
+        self.assertEqual(self.A[1], self.r)
+        self.assertMatches(self.A[1:3], [self.r, self.t])
+        self.assertMatches(qa(np.arange(8).reshape(2,4)), [qt(0,1,2,3), qt(4,5,6,7)])
+        np.testing.assert_array_equal(self.A.vector, [[2,3,4],[6,7,8],[10,11,12],[-7,-4,8]])
+        with self.assertRaises(ValueError):
+            qa([[1,2,3]])
+
+    def test_elementwise(self):
+        pairs = list(zip(self.A, self.B))
+        self.assertMatches(self.A + self.B, [a+b for a,b in pairs])
+        self.assertMatches(self.A - self.B, [a-b for a,b in pairs])
+        self.assertMatches(self.A * self.B, [a*b for a,b in pairs])
+        self.assertMatches(self.A / self.B, [a/b for a,b in pairs])
+        self.assertMatches(-self.A, [-a for a in self.A])
+        self.assertMatches(self.A.conjugate(), [a.conjugate() for a in self.A])
+        self.assertMatches(self.A.inverse(), [a.inverse() for a in self.A])
+        self.assertMatches(self.A**3, [a**3 for a in self.A])
+        self.assertMatches(self.A**-2, [a**-2 for a in self.A])
+        self.assertMatches(self.A**0, [qt(1,0,0,0)]*4)
+        np.testing.assert_allclose((self.A**13)._q, [(a**13)._q for a in self.A], rtol=1e-13)
+        self.assertMatches(self.A**0.5, [a**0.5 for a in self.A])
+        self.assertMatches(qa([qt(0,0,0,0), self.q])**2.5, [qt(0,0,0,0), self.q**2.5])
+        np.testing.assert_array_almost_equal(abs(self.A), [abs(a) for a in self.A], decimal=12)
+        np.testing.assert_array_equal(self.A == self.A, [True]*4)
+
+    def test_broadcasting(self):
+        for x in [self.q, 2, 2.2, 1+2j]:
+            self.assertMatches(self.A + x, [a+x for a in self.A])
+            self.assertMatches(x + self.A, [x+a for a in self.A])
+            self.assertMatches(self.A - x, [a-x for a in self.A])
+            self.assertMatches(x - self.A, [x-a for a in self.A])
+            self.assertMatches(self.A * x, [a*x for a in self.A])
+            self.assertMatches(x * self.A, [x*a for a in self.A])
+            self.assertMatches(self.A / x, [a/x for a in self.A])
+            self.assertMatches(x / self.A, [x/a for a in self.A])
+
+    def test_rotate_points(self):
+        P = np.array([[1,0,0],[0,2,0],[0,0,3],[1.5,-2,0.5]])
+        # Quarter turn about z
+        z90 = qt(np.cos(np.pi/4),0,0,np.sin(np.pi/4))
+        np.testing.assert_array_almost_equal(z90.rotate_points(P), [[0,1,0],[-2,0,0],[0,0,3],[2,1.5,0.5]], decimal=14)
+        # Matches the sandwich product, including for non-unit quaternions
+        for a in self.A:
+            sandwich = [(a * qt(0,*p) * a.inverse()).vector for p in P]
+            np.testing.assert_array_almost_equal(a.rotate_points(P), sandwich, decimal=12)
+        sandwich = [(a * qt(0,*p) * a.inverse()).vector for a,p in zip(self.A, P)]
+        np.testing.assert_array_almost_equal(self.A.rotate_points(P), sandwich, decimal=12)
+        np.testing.assert_array_almost_equal(self.A.rotate_points(P[3]), [a.rotate_points(P[3]) for a in self.A], decimal=12)
+        with self.assertRaises(ZeroDivisionError):
+            qt(0,0,0,0).rotate_points(P)
+
+    def test_rotation_matrix(self):
+        z90 = qt(np.cos(np.pi/4),0,0,np.sin(np.pi/4))
+        np.testing.assert_array_almost_equal(z90.to_rotation_matrix(), [[0,-1,0],[1,0,0],[0,0,1]], decimal=14)
+        np.testing.assert_array_almost_equal(qt.from_rotation_matrix([[0,-1,0],[1,0,0],[0,0,1]])._q, z90._q, decimal=14)
+        # Half turns exercise every branch of Shepperd's method
+        for m, q in [(np.diag([1,-1,-1]), qt(0,1,0,0)), (np.diag([-1,1,-1]), qt(0,0,1,0)), (np.diag([-1,-1,1]), qt(0,0,0,1))]:
+            np.testing.assert_array_almost_equal(qt.from_rotation_matrix(m)._q, q._q, decimal=14)
+        M = self.A.to_rotation_matrix()
+        self.assertEqual(M.shape, (4,3,3))
+        np.testing.assert_array_almost_equal(M, [a.to_rotation_matrix() for a in self.A], decimal=14)
+        np.testing.assert_array_almost_equal(M @ [1.5,-2,0.5], self.A.rotate_points([1.5,-2,0.5]), decimal=12)
+        # Round trip up to sign, which is fixed to w >= 0
+        U = qa(self.A._q / abs(self.A)[:, None])
+        B = qa.from_rotation_matrix(M)
+        np.testing.assert_array_almost_equal(B._q, U._q * np.sign(U.real)[:, None], decimal=14)
+
+    def test_axis_angle(self):
+        axis, angle = qt.from_axis_angle([0,0,2], np.pi/2).to_axis_angle()
+        np.testing.assert_array_almost_equal(axis, [0,0,1], decimal=14)
+        self.assertAlmostEqual(angle, np.pi/2, places=14)
+        axis, angle = qt(1,0,0,0).to_axis_angle()
+        np.testing.assert_array_equal(axis, [1,0,0])
+        self.assertEqual(angle, 0)
+        U = qa(self.A._q / abs(self.A)[:, None])
+        axes, angles = self.A.to_axis_angle()
+        self.assertEqual(axes.shape, (4,3))
+        np.testing.assert_array_almost_equal(qa.from_axis_angle(axes, angles)._q, U._q, decimal=14)
+        with self.assertRaises(ValueError):
+            qt.from_axis_angle([0,0,0], 1)
+
+    def test_euler(self):
+        def R(axis, t):
+            c, s = np.cos(t), np.sin(t)
+            return {'x': np.array([[1,0,0],[0,c,-s],[0,s,c]]),
+                    'y': np.array([[c,0,s],[0,1,0],[-s,0,c]]),
+                    'z': np.array([[c,-s,0],[s,c,0],[0,0,1]])}[axis]
+        a, b, c = 0.3, -0.5, 1.1
+        # Extrinsic compose right to left, intrinsic left to right
+        np.testing.assert_array_almost_equal(qt.from_euler([a,b,c], 'xyz').to_rotation_matrix(), R('z',c) @ R('y',b) @ R('x',a), decimal=14)
+        np.testing.assert_array_almost_equal(qt.from_euler([a,b,c], 'ZXZ').to_rotation_matrix(), R('z',a) @ R('x',b) @ R('z',c), decimal=14)
+        np.testing.assert_array_almost_equal(qt.from_euler([a,b,c], 'xyz').to_euler('xyz'), [a,b,c], decimal=14)
+        # Every sequence round trips up to sign
+        U = self.A._q / abs(self.A)[:, None]
+        for sequence in ['xyz','xzy','yxz','yzx','zxy','zyx','xyx','xzx','yxy','yzy','zxz','zyz']:
+            for seq in [sequence, sequence.upper()]:
+                B = qa.from_euler(self.A.to_euler(seq), seq)
+                np.testing.assert_array_almost_equal(np.abs(np.sum(B._q * U, axis=1)), [1]*4, decimal=14)
+        # Gimbal lock puts the whole rotation on the first angle
+        np.testing.assert_array_almost_equal(qt.from_euler([a,np.pi/2,c], 'XYZ').to_euler('XYZ'), [a+c,np.pi/2,0], decimal=7)
+        with self.assertRaises(ValueError):
+            qt(1,0,0,0).to_euler('xxy')
+        with self.assertRaises(ValueError):
+            qt(1,0,0,0).to_euler('xYz')
+
+    def test_exp_log(self):
+        self.assertMatches(self.A.exp(), [a.exp() for a in self.A])
+        self.assertMatches(self.A.log(), [a.log() for a in self.A])
+        self.assertMatches(qa([qt(-2,0,0,0), qt(0,0,0,0)]).exp(), [qt(-2,0,0,0).exp(), qt(1,0,0,0)])
+        self.assertMatches(qa([qt(-2,0,0,0)]).log(), [qt(-2,0,0,0).log()])
+        with self.assertRaises(ZeroDivisionError):
+            qa([qt(0,0,0,0)]).log()
+
+    def test_slerp(self):
+        q0 = qt(1,0,0,0)
+        q1 = qt.from_axis_angle([0,0,1], 1.0)
+        np.testing.assert_almost_equal(slerp(q0, q1, 0.25), qt.from_axis_angle([0,0,1], 0.25), decimal=14, err_msg='', verbose=True)
+        # Shorter arc and nearly parallel keys
+        np.testing.assert_almost_equal(slerp(q0, -q1, 0.25), qt.from_axis_angle([0,0,1], 0.25), decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(slerp(q0, qt(1,1e-12,0,0), 0.5), qt(1,5e-13,0,0), decimal=14, err_msg='', verbose=True)
+        # Arrays of t and arrays of keys
+        t = np.linspace(0, 1, 5)
+        self.assertMatches(slerp(q0, q1, t), [qt.from_axis_angle([0,0,1], x) for x in t])
+        U = qa(self.A._q / abs(self.A)[:, None])
+        V = qa(self.B._q / abs(self.B)[:, None])
+        self.assertMatches(slerp(U, V, 0), list(U))
+        self.assertMatches(slerp(U, V, t[:4]), [slerp(u, v, x) for u, v, x in zip(U, V, t)])
+
+    def test_squad(self):
+        q0 = qt(1,0,0,0)
+        q1 = qt.from_axis_angle([0,0,1], 1.0)
+        # With controls at the keys squad follows the slerp arc
+        np.testing.assert_almost_equal(squad(q0, q0, q1, q1, 0.3), slerp(q0, q1, 0.3), decimal=14, err_msg='', verbose=True)
+        # Keys along one axis at even spacing stay on that axis at even speed
+        keys = qa([qt.from_axis_angle([0,0,1], x) for x in [0, 0.5, 1.0, 1.5]])
+        a = squad_controls(keys)
+        self.assertMatches(a[1:3], list(keys[1:3]))
+        self.assertMatches(squad(keys[1], a[1], a[2], keys[2], [0.25, 0.5]), [qt.from_axis_angle([0,0,1], x) for x in [0.625, 0.75]])
+
+    def test_interpolate(self):
+        times = [0, 1, 3]
+        keys = qa([qt.from_axis_angle([0,0,1], x) for x in [0, 1.0, 2.0]])
+        new_times = [-1, 0, 0.5, 1, 2, 3, 4]
+        self.assertMatches(interpolate(times, keys, new_times), [qt.from_axis_angle([0,0,1], x) for x in [0, 0, 0.5, 1, 1.5, 2, 2]])
+        R = interpolate(times, keys, new_times, method='squad')
+        self.assertMatches(R[[1,3,5]], list(keys))
+        # Sign flips between keys do not change the path
+        flipped = qa(keys._q * [[1],[-1],[1]])
+        self.assertMatches(interpolate(times, flipped, new_times), list(interpolate(times, keys, new_times)))
+        with self.assertRaises(ValueError):
+            interpolate(times, keys, new_times, method='cubic')
+
+    def test_numpy_ufuncs(self):
+        x = np.array([1, 2.5, -3, 4])
+        # Real ndarrays act elementwise as real quaternions, never as object arrays
+        for result, expected in [(x * self.q, [a*self.q for a in x]), (self.q * x, [self.q*a for a in x]),
+                                 (x * self.A, [a*b for a,b in zip(x, self.A)]), (self.A * x, [b*a for a,b in zip(x, self.A)]),
+                                 (x + self.A, [a+b for a,b in zip(x, self.A)]), (x / self.A, [a/b for a,b in zip(x, self.A)]),
+                                 (np.multiply(self.A, self.B), list(self.A * self.B)), (np.add(self.q, self.A), list(self.q + self.A)),
+                                 (np.conjugate(self.A), list(self.A.conjugate())), (np.power(self.A, 3), list(self.A**3)),
+                                 ((1+2j)*np.ones(4) + self.A, [(1+2j)+a for a in self.A]),
+                                 ((1+2j)*np.ones(4) / self.A, [(1+2j)/a for a in self.A]),
+                                 (np.array([1+2j]) / self.q, [(1+2j)/self.q]),
+                                 (self.A**np.int64(2), list(self.A**2)), (self.A**np.float64(0.5), list(self.A**0.5))]:
+            self.assertEqual(type(result), qa)
+            self.assertMatches(result, expected)
+        np.testing.assert_array_almost_equal(np.abs(self.A), abs(self.A), decimal=14)
+        np.testing.assert_array_equal(np.equal(self.A, self.r), [False, True, False, False])
+        # Scalar calls go through the Quaternion operators
+        self.assertEqual(np.multiply(np.float64(2), self.q), qt(2,4,6,8))
+        self.assertEqual(np.float64(2) * self.q, qt(2,4,6,8))
+        self.assertEqual(self.q + np.int64(1), qt(2,2,3,4))
+        self.assertEqual(np.abs(qt(2,24,16,8)), 30.0)
+        # Operands broadcast along a single axis only
+        for func in (lambda: np.ones((2,2)) * self.q, lambda: self.q * np.ones((2,2)),
+                     lambda: np.ones((2,2)) * self.A[:1], lambda: np.ones((4,1)) + self.A):
+            self.assertRaises(TypeError, func)
+        self.assertMatches(np.ones(3) * self.q, [self.q] * 3)
+        # Reductions keep the order of the Hamilton product
+        np.testing.assert_almost_equal(np.multiply.reduce(self.A), self.q*self.r*self.t*self.s, decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(np.prod(self.A[:3]), self.q*self.r*self.t, decimal=14, err_msg='', verbose=True)
+        np.testing.assert_almost_equal(np.sum(self.A), self.q+self.r+self.t+self.s, decimal=14, err_msg='', verbose=True)
+        self.assertMatches(np.multiply.accumulate(self.A), [self.q, self.q*self.r, self.q*self.r*self.t, self.q*self.r*self.t*self.s])
+        self.assertMatches(np.cumsum(self.A), [self.q, self.q+self.r, self.q+self.r+self.t, self.q+self.r+self.t+self.s])
+        self.assertMatches(np.concatenate([self.A, self.B[:1]]), list(self.A) + [self.s])
+        for func in (np.sum, np.prod, np.cumsum, np.cumprod, np.size):
+            self.assertRaises(ValueError, func, self.A, axis=1)
+        self.assertEqual(np.sum(self.A, axis=0), np.sum(self.A))
+        # out= writes into the existing buffer
+        C = qa(self.A)
+        np.multiply(self.A, self.B, out=C)
+        self.assertMatches(C, list(self.A * self.B))
+
+    def test_integrate_angular_velocity(self):
+        # Constant rate about z over uneven timestamps
+        times = np.array([0, 0.1, 0.25, 0.3, 0.7, 1.0, 1.2, 2.0])
+        rates = np.tile([0, 0, 0.5], (8, 1))
+        chunks = list(integrate_angular_velocity(iter_chunks(rates, times, size=3)))
+        self.assertEqual([len(c) for c in chunks], [3, 3, 2])
+        expected = [qt.from_axis_angle([0,0,1], 0.5*t) for t in times]
+        self.assertMatches(np.concatenate(chunks), expected)
+        # Streaming matches the sample by sample product in both frames
+        rates = np.random.default_rng(0).normal(size=(8, 3))
+        for frame in ['body', 'world']:
+            q = self.q / abs(self.q)
+            expected = [q]
+            for w, dt in zip(rates[:-1], np.diff(times)):
+                dq = qt(0, *(w * dt / 2)).exp()
+                q = q * dq if frame == 'body' else dq * q
+                expected.append(q)
+            chunks = integrate_angular_velocity(iter_chunks(rates, times, size=3), q0=self.q, frame=frame)
+            self.assertMatches(np.concatenate(list(chunks)), expected)
+        # Fixed sample period
+        chunks = integrate_angular_velocity(iter_chunks(rates, size=5), dt=0.1)
+        expected = integrate_angular_velocity([(rates, 0.1*np.arange(8))])
+        self.assertMatches(np.concatenate(list(chunks)), list(next(expected)))
+
+    def test_parallel_products(self):
+        rng = np.random.default_rng(0)
+        U = qa(rng.normal(size=(50, 4)))
+        U = qa(U._q / abs(U)[:, None])
+        expected = [U[0]]
+        for u in list(U)[1:]:
+            expected.append(expected[-1] * u)
+        serial = cumprod(U, workers=1, block_size=7)
+        self.assertMatches(serial, expected)
+        np.testing.assert_almost_equal(prod(U, workers=1, block_size=7), expected[-1], decimal=13, err_msg='', verbose=True)
+        # Fixed blocks give identical bits whatever the pool
+        for workers, executor in [(3, 'thread'), (8, 'thread'), (2, 'process')]:
+            np.testing.assert_array_equal(cumprod(U, workers=workers, executor=executor, block_size=7)._q, serial._q)
+            self.assertEqual(prod(U, workers=workers, executor=executor, block_size=7)._q, prod(U, workers=1, block_size=7)._q)
+        self.assertMatches(self.A.cumprod(), [self.q, self.q*self.r, self.q*self.r*self.t, self.q*self.r*self.t*self.s])
+        np.testing.assert_almost_equal(self.A.prod(digits=10), self.q*self.r*self.t*self.s, decimal=14, err_msg='', verbose=True)
+        self.assertEqual(prod(qa()), qt(1,0,0,0))
+        with self.assertRaises(ValueError):
+            cumprod(U, executor='gpu', workers=2, block_size=7)
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'track.qarr')
+            times = np.array([0, 0.1, 0.2, 0.3])
+            save_quaternions(path, self.A, times)
+            # Header plus packed payload plus timestamps
+            self.assertEqual(os.path.getsize(path), 64 + 4*4*8 + 4*8)
+            with open_quaternions(path) as store:
+                self.assertEqual(len(store), 4)
+                self.assertEqual(store[1], self.r)
+                self.assertMatches(store[1:3], [self.r, self.t])
+                np.testing.assert_array_equal(store.timestamps, times)
+                self.assertIsInstance(store.quaternions._q.base, np.memmap)
+                with self.assertRaises(ValueError):
+                    store[0] = self.q
+            # Rotate a slice in place
+            with open_quaternions(path, 'r+') as store:
+                store[1:3] = self.q * store[1:3]
+            with open_quaternions(path) as store:
+                self.assertMatches(store.quaternions, [self.q, self.q*self.r, self.q*self.t, self.s])
+            # Stores can be filled chunk by chunk
+            path = os.path.join(tmp, 'empty.qarr')
+            with create_quaternions(path, 3) as store:
+                store[:] = [self.q]*3
+                self.assertIsNone(store.timestamps)
+            with open_quaternions(path) as store:
+                self.assertMatches(store.quaternions, [self.q]*3)
+            with open(path, 'r+b') as f:
+                f.write(b'NOTQUATS')
+            with self.assertRaises(ValueError):
+                open_quaternions(path)
+
+    def test_precision_modes(self):
+
+        q = np.random.default_rng(2).normal(size=(6, 4))
+        A = qa(q)
+        self.assertEqual(A.dtype, np.float64)
+        self.assertEqual(qa(q.astype(np.float32)).dtype, np.float32)
+
+        for dtype in (np.float32, np.float16):
+            B = qa(q, dtype)
+            self.assertEqual(B.dtype, dtype)
+            self.assertEqual(B._q.nbytes, A._q.nbytes * np.dtype(dtype).itemsize // 8)
+            for result in (B * B, B + 1, 2 * B, B / B, B.inverse(), B ** 3, B ** 0.5,
+                           B.exp(), B.conjugate(), B * qt(1,2,3,4), np.multiply(B, B), B.cumprod(),
+                           qa(B), slerp(B, B[::-1], 0.3), squad_controls(B), interpolate(range(6), B, [0.5, 2.5]),
+                           interpolate(range(6), B, [0.5, 2.5], 'squad')):
+                self.assertEqual(result.dtype, dtype)
+            # float16 is storage only - products are computed in float32
+            self.assertEqual(abs(B).dtype, np.float32)
+            self.assertEqual(geodesic_distance(B, B[::-1]).dtype, np.float32)
+            self.assertEqual(chordal_distance(B, qt(1,2,3,4)).dtype, np.float32)
+            rtol = 1e-5 if dtype == np.float32 else 1e-2
+            np.testing.assert_allclose((B * B).astype(np.float64)._q, (B.astype(np.float64) ** 2)._q, rtol=rtol, atol=rtol)
+
+        # Casting between modes is explicit
+        C = A.astype(np.float32)
+        self.assertEqual(C.dtype, np.float32)
+        self.assertEqual(A.dtype, np.float64)
+        self.assertRaises(TypeError, lambda: A * C)
+        self.assertRaises(TypeError, lambda: np.add(A, C))
+        self.assertRaises(TypeError, np.concatenate, [A, C])
+        self.assertRaises(ValueError, qa, q, np.int32)
+        np.testing.assert_allclose((A * C.astype(np.float64))._q, (A * A)._q, rtol=1e-6)
+
+        # Stores keep the dtype they were saved in
+        path = os.path.join(tempfile.mkdtemp(), 'q16.qarr')
+        save_quaternions(path, A.astype(np.float16))
+        with open_quaternions(path) as store:
+            self.assertEqual(store.quaternions.dtype, np.float16)
+            np.testing.assert_array_equal(store.quaternions._q, A.astype(np.float16)._q)
+        os.remove(path)
+
+    def test_csv(self):
+
+        rng = np.random.default_rng(4)
+        times = np.cumsum(rng.random(500))
+        path = os.path.join(tempfile.mkdtemp(), 'q.csv')
+        for dtype in (np.float64, np.float32, np.float16):
+            A = qa(rng.normal(size=(500, 4)) * 10.0 ** rng.integers(-5, 5, size=(500, 1)), dtype)
+            to_csv(path, A, chunk_size=64)
+            B, timestamps = from_csv(path, dtype, chunk_size=100)
+            self.assertIsNone(timestamps)
+            self.assertEqual(B.dtype, dtype)
+            # Round trips are exact
+            np.testing.assert_array_equal(B._q, A._q)
+
+        A.to_csv(path, timestamps=times)
+        with open(path) as f:
+            self.assertEqual(f.readline(), 't,w,x,y,z\n')
+        B, timestamps = from_csv(path, np.float16)
+        np.testing.assert_array_equal(B._q, A._q)
+        np.testing.assert_array_equal(timestamps, times)
+
+        B, timestamps = from_csv(io.StringIO('w,x,y,z\n'))
+        self.assertEqual(len(B), 0)
+        self.assertRaises(ValueError, from_csv, io.StringIO('a,b\n1,2\n'))
+        self.assertRaises(ValueError, from_csv, io.StringIO('w,x,y,z\n1,2,3\n'))
+        os.remove(path)
+
+    def test_rotation_keys(self):
+        A = qa(np.random.default_rng(5).normal(size=(50, 4)))
+        keys = A.rotation_keys()
+        self.assertEqual(keys.dtype, np.int64)
+        np.testing.assert_array_equal(keys, (-A).rotation_keys())
+        self.assertEqual([tuple(k) for k in keys.tolist()], [q.rotation_key() for q in A])
+        # Dedup orientations
+        B = np.concatenate([A, -A, A * 3])
+        self.assertEqual(len(np.unique(B.rotation_keys(), axis=0)), 50)
+
+    def test_lazy_arrays(self):
+        rng = np.random.default_rng(7)
+        A = qa(rng.normal(size=(10000, 4)))
+        B = qa(rng.normal(size=(10000, 4)))
+        q, r = qt(1,2,3,4), qt(-1,0.5,2,1)
+        a, b = lazy(A), lazy(B)
+
+        e = ((a * q * b.inverse()).conjugate() / r + B)
+        result = e.evaluate()
+        self.assertEqual(type(result), qa)
+        np.testing.assert_allclose(result._q, ((A * q * B.inverse()).conjugate() / r + B)._q, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(e.real, result.real)
+        self.assertEqual(len(e), 10000)
+        np.testing.assert_allclose((a ** 3).evaluate()._q, (A ** 3)._q, rtol=1e-12)
+
+        # Cancelled arrays still set the length and dtype
+        ones = (a * a.inverse() * q).evaluate()
+        self.assertEqual(len(ones), 10000)
+        self.assertTrue(np.all(ones == q))
+        F = A.astype(np.float32)
+        self.assertEqual((lazy(F) * q + 1).evaluate().dtype, np.float32)
+        self.assertRaises(TypeError, (lazy(F) * A).evaluate)
+        # Mixing with eager operands
+        self.assertTrue(np.all(A * lazy(q) == A * q))
+
+    def test_norms_and_distances(self):
+        rng = np.random.default_rng(8)
+        A = qa(rng.normal(size=(100, 4)))
+        np.testing.assert_allclose(A.norm(), [abs(q) for q in A], rtol=1e-13)
+        np.testing.assert_allclose(A.norm_squared(), A.norm()**2, rtol=1e-14)
+        np.testing.assert_array_equal(abs(A), A.norm())
+
+        # In place
+        buffer = A._q
+        self.assertIs(A.normalize(), A)
+        self.assertIs(A._q, buffer)
+        np.testing.assert_allclose(A.norm(), 1, rtol=1e-15)
+        H = qa(rng.normal(size=(10, 4)), np.float16).normalize()
+        self.assertEqual(H.dtype, np.float16)
+        np.testing.assert_allclose(H.norm(), 1, rtol=2e-3)
+        self.assertRaises(ZeroDivisionError, qa([[0,0,0,0]]).normalize)
+
+        # Rotation distances - q and -q are the same rotation
+        q = qt(1,2,3,4)
+        for angle in (1e-9, 0.5, 2.5, np.pi):
+            r = qt.from_axis_angle([0.3,-1,2], angle) * q
+            self.assertAlmostEqual(geodesic_distance(q, r), angle, delta=1e-12 + angle * 1e-10)
+            self.assertAlmostEqual(geodesic_distance(q, -r), angle, delta=1e-12 + angle * 1e-10)
+            self.assertAlmostEqual(chordal_distance(q, r), 2*np.sin(angle/4), delta=1e-12)
+        self.assertEqual(geodesic_distance(q, -2*q), 0.0)
+        distances = geodesic_distance(A, A[0])
+        self.assertEqual(distances.shape, (100,))
+        self.assertEqual(distances[0], 0.0)
+        self.assertTrue(np.all((distances >= 0) & (distances <= np.pi)))
+
+    def test_renormalize(self):
+        rng = np.random.default_rng(9)
+        steps = qa(rng.normal(size=(50000, 4)) * [1, 1e-3, 1e-3, 1e-3] + [1, 0, 0, 0], np.float32).normalize()
+        drifted = cumprod(steps, block_size=1024)
+        kept = cumprod(steps, block_size=1024, renormalize=True)
+        self.assertGreater(np.abs(drifted.norm() - 1).max(), 1e-5)
+        self.assertLess(np.abs(kept.norm() - 1).max(), 1e-6)
+        self.assertLess(geodesic_distance(kept[-1], drifted[-1]), 1e-3)
+        self.assertLess(abs(prod(steps, block_size=1024, renormalize=True).norm() - 1), 1e-6)
+
+    def test_mean_and_index(self):
+
+        # Markley mean ignores signs and follows the weights
+        z = [qt.from_axis_angle([0,0,1], x) for x in (0.1, 0.2, 0.3)]
+        Z = qa([z[0], -z[1], z[2]])
+        m = mean_rotation(Z)
+        self.assertAlmostEqual(m.to_axis_angle()[1], 0.2)
+        self.assertTrue(m.real > 0)
+        self.assertAlmostEqual(mean_rotation(Z, [1, 0, 0]).to_axis_angle()[1], 0.1)
+        self.assertRaises(ValueError, mean_rotation, Z, [1, 1])
+        self.assertRaises(ValueError, mean_rotation, Z, [1, -1, 1])
+
+        # k-nearest and radius queries agree with a brute force search
+        rng = np.random.default_rng(0)
+        P = qa(rng.normal(size=(2000, 4)))
+        Q = qa(rng.normal(size=(50, 4)))
+        index = RotationIndex(P, leaf_size=8)
+        self.assertEqual(len(index), 2000)
+        D = np.array([geodesic_distance(P, q) for q in Q])
+        angles, indices = index.query(Q, k=3)
+        self.assertEqual(indices.shape, (50, 3))
+        np.testing.assert_allclose(angles, np.sort(D, axis=1)[:, :3])
+        np.testing.assert_array_equal(indices, np.argsort(D, axis=1)[:, :3])
+        found, angles = index.query_radius(Q, 0.5, return_distance=True)
+        for row, near, angle in zip(D, found, angles):
+            self.assertEqual(set(near), set(np.nonzero(row <= 0.5)[0]))
+            np.testing.assert_allclose(angle, row[near])
+
+        # Brute force agreement over random sizes, leaf sizes and k (n=1 included)
+        for n in (1, 2, 3, 17, 100, 257):
+            points = qa(rng.normal(size=(n, 4)))
+            queries = qa(rng.normal(size=(6, 4)))
+            brute = np.array([np.atleast_1d(geodesic_distance(points, q)) for q in queries])
+            for leaf_size in (1, 4, 32):
+                for k in sorted({1, (n + 1) // 2, n}):
+                    angles, indices = RotationIndex(points, leaf_size).query(queries, k)
+                    np.testing.assert_allclose(angles, np.sort(brute, axis=1)[:, :k])
+                    np.testing.assert_allclose(np.take_along_axis(brute, indices, axis=1), angles)
+
+        # q and -q are the same rotation
+        angles, indices = index.query(-P[7], k=1)
+        self.assertEqual(indices[0], 7)
+        self.assertAlmostEqual(angles[0], 0)
+        self.assertIn(7, index.query_radius(-P[7], 1e-6))
+        self.assertRaises(ValueError, index.query, Q, 0)
+        self.assertRaises(ValueError, index.query, Q, 2001)
+
+    def test_inverse_zero(self):
+        with self.assertRaises(ZeroDivisionError):
+            qa([qt(0,0,0,0)]).inverse()
+
 if __name__ == "__main__":
    unittest.main()
\ No newline at end of file